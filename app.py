@@ -1,25 +1,135 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response, has_request_context, make_response, stream_with_context, \
+    url_for
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import click
+import csv
+import io
+import itertools
+import hashlib
+import hmac
+import json
+import math
+import os
+import random
+import time
 import stripe
 import uuid
 import key
+from cache import CatalogCache, LRUCache
+from compression import compress_response
+from fastjson import OrjsonProvider
+import logsystem
 from logsystem import LogSystem
+from hashing import PasswordHasher, PasswordHasherBusy
+from metrics import Metrics
+from ratelimit import TokenBucketLimiter
+from tasks import PeriodicTask, QueueWorker, WorkerPool
+from tokens import TokenSigner, RevocationList
 
 game_name = 'Name of your Game'
 api_version = '0.0.1'
 stripe.api_key = key.privat_stripe_api_key
+stripe.api_base = os.environ.get('STRIPE_API_BASE', stripe.api_base)  # e.g. a local fake Stripe server
 uuid_salt = 'your_salt_value'  # Replace 'your_salt_value' with a secure, hard-to-guess value
+log_queue_size = 10000  # Records the background log writer can queue
+log_overflow = 'sample'  # What to do with records when that queue is full: 'block', 'drop' or 'sample'
+log_format = 'text'  # 'text' for humans or 'json' for one JSON object per line
+slow_query_threshold_ms = 100  # Queries slower than this are written to the slow query log
+n_plus_one_threshold = 10  # Executions of the same statement in one request that are reported as N+1
+product_cache_ttl = 60  # Seconds the product list from Stripe is served from memory
+product_cache_max_stale = 300  # Seconds an expired product list is still served while it is refreshed
+catalog_sync_interval = 300  # Seconds between syncs of the local product catalog with Stripe
+account_recent_purchases = 10  # Number of purchases returned by GET /account
+auth_cache_size = 10000  # Users whose secret and username are kept in memory
+auth_cache_ttl = 60  # Seconds before a cached secret is read from the database again
+password_hash_method = 'pbkdf2:sha256:1000000'  # Hash method and cost, older hashes are renewed on the next login
+password_hash_workers = None  # Processes that hash passwords, None for one per CPU
+password_hash_max_pending = 64  # Hash operations that may wait for a process before requests get a 503
+login_rate_per_username = 10  # Login attempts per minute and username
+login_burst_per_username = 5  # Attempts per username that may be made at once
+login_rate_per_ip = 60  # Password checks and account creations per minute and IP address
+login_burst_per_ip = 20  # Attempts per IP address that may be made at once
+access_token_ttl = 900  # Seconds an access token from /login is valid
+refresh_token_ttl = 30 * 24 * 3600  # Seconds a refresh token is valid
+token_revocation_refresh = 10  # Seconds before revocations made by other processes are picked up
+coin_batch_max_size = 1000  # Maximum number of operations in POST /account/coins/batch
+coin_snapshot_interval = 3600  # Seconds between runs of the coin balance snapshot job
+coin_snapshot_min_transactions = 100  # New ledger entries a user needs before a new snapshot is taken
+bulk_import_workers = 8  # Concurrent Stripe requests of POST /product/bulk
+bulk_import_max_items = 1000  # Maximum number of products in POST /product/bulk
+stripe_rate_limit_retries = 5  # Retries of a Stripe call that was rate limited (HTTP 429)
+stripe_rate_limit_backoff = 0.5  # Seconds before the first retry, doubled for every further one
+webhook_batch_size = 200  # Webhook events applied per transaction
+webhook_flush_interval = 0.2  # Seconds the webhook worker waits for a batch to fill up
+webhook_retry_interval = 60  # Seconds between checks for received but unapplied webhook events
+webhook_retry_backoff = 60  # Seconds before an event that failed with a transient error is retried, doubled every time
+webhook_max_attempts = 10  # Attempts of an event before it is given up
+job_workers = 4  # Threads that run background jobs such as creating products in Stripe
+job_max_attempts = 5  # Attempts of a job before it fails
+job_retry_backoff = 2  # Seconds before the first retry of a failed job, doubled for every further one
+job_lease = 300  # Seconds after which a running job whose process died is run again
+job_poll_interval = 5  # Seconds between checks for due jobs when no new job was queued
+idempotency_key_ttl = 24 * 3600  # Seconds a response is replayed for a repeated Idempotency-Key
+idempotency_purge_interval = 3600  # Seconds between the deletions of expired idempotency keys
+idempotency_purge_batch = 1000  # Expired keys deleted per transaction
+account_bulk_max_size = 1000  # Maximum number of accounts in POST /account/bulk
+account_bulk_chunk_size = 500  # Accounts inserted per transaction
+export_batch_size = 1000  # Rows fetched per round trip and written per chunk by the exports
+compression_min_size = 1024  # Bytes from which responses are compressed (gzip, or brotli if installed)
 
 app = Flask(__name__)
-LogSystem = LogSystem()
+app.json = OrjsonProvider(app)  # orjson if installed, otherwise the standard json module
+LogSystem = LogSystem(background=True, queue_size=log_queue_size, overflow=log_overflow, log_format=log_format)
 
-# Configure the database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///game_shop.db'  # SQLite as the database
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Configure the database (see config.py)
+app.config.from_object('config')
 db = SQLAlchemy(app)
 
 
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.execute(f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_SIZE_KB']}")  # Negative means KiB
+    cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        db.event.listen(db.engine, 'connect', _configure_sqlite_connection)
+
+# Metrics, served on /metrics in the Prometheus text format
+metrics = Metrics()
+request_seconds = metrics.histogram('shop_request_duration_seconds', 'Request latency by route',
+                                    ['method', 'route'])
+requests_total = metrics.counter('shop_requests_total', 'Requests by route and status', ['method', 'route', 'status'])
+requests_in_flight = metrics.gauge('shop_requests_in_flight', 'Requests currently being handled')
+stripe_seconds = metrics.histogram('shop_stripe_request_duration_seconds', 'Duration of Stripe API calls',
+                                   ['operation'])
+stripe_rate_limited_total = metrics.counter('shop_stripe_rate_limited_total',
+                                            'Stripe calls retried after a rate limit error', ['operation'])
+password_hash_seconds = metrics.histogram('shop_password_hash_duration_seconds',
+                                          'Duration of password hashing and checks', ['operation'])
+login_rejected_total = metrics.counter('shop_login_rejected_total',
+                                       'Password checks and account creations rejected before hashing', ['reason'])
+db_commit_seconds = metrics.histogram('shop_db_commit_duration_seconds', 'Duration of database commits (incl. flush)')
+db_query_seconds = metrics.histogram('shop_db_query_duration_seconds', 'Duration of SQL statements')
+webhook_events_total = metrics.counter('shop_webhook_events_total', 'Stripe webhook events by result',
+                                      ['result'])
+db_queries_per_request = metrics.histogram('shop_db_queries_per_request', 'SQL statements per request',
+                                           buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+
+# Log of slow SQL statements with their query plans
+SlowQueryLog = logsystem.LogSystem(background=True, log_format=log_format, name="SlowQueryLogger",
+                                   file_prefix="slow-queries-")
+
+
 # Database model for Users
 class User(db.Model):
     id = db.Column(db.String(36), primary_key=True)  # Unique user ID
@@ -28,6 +138,8 @@ class User(db.Model):
     secret = db.Column(db.String(36), unique=True, nullable=False)  # Unique secure token
     data = db.Column(db.JSON, default={})  # Flexible JSON data field
     coins = db.Column(db.Integer, default=0)  # Coins field with default value
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # For the ETag, see _conditional_response()
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # None for users from before this column
 
 
 # Database model for Purchase history
@@ -37,11 +149,1060 @@ class PurchaseHistory(db.Model):
     product_name = db.Column(db.String(100), nullable=False)
     purchase_date = db.Column(db.DateTime, nullable=False)  # Date of purchase
 
+    __table_args__ = (
+        db.Index('ix_purchase_history_user_date', 'user_id', 'purchase_date', 'id'),
+    )
+
+
+# Database model for the coin ledger (append-only, one row per coin change)
+class CoinTransaction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)  # Linked to User
+    amount = db.Column(db.Integer, nullable=False)  # Positive for credits, negative for debits
+    balance = db.Column(db.Integer, nullable=False)  # Balance after the change
+    reason = db.Column(db.String(50), nullable=False)  # e.g. "add" or "deduct"
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_coin_transaction_user_created', 'user_id', 'created_at'),
+    )
+
+
+# Database model for coin balance snapshots, a balance is the snapshot plus all later ledger entries
+class CoinSnapshot(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)  # Linked to User
+    transaction_id = db.Column(db.Integer, db.ForeignKey('coin_transaction.id'), nullable=False)  # Last included entry
+    balance = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_coin_snapshot_user_transaction', 'user_id', 'transaction_id'),
+    )
+
+
+# Database model for forced logouts: tokens of the user issued until revoked_before are invalid
+class TokenRevocation(db.Model):
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), primary_key=True)  # Linked to User
+    revoked_before = db.Column(db.Float, nullable=False)  # Unix timestamp
+
+
+# Database model for received Stripe webhook events, the primary key deduplicates redeliveries
+class StripeEvent(db.Model):
+    id = db.Column(db.String(255), primary_key=True)  # Stripe event ID
+    type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    received_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)  # None until the worker applied the event
+    error = db.Column(db.Text)  # Why the event couldn't be applied
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Failed attempts
+    next_attempt_at = db.Column(db.DateTime)  # After a transient error: when the event is retried
+
+    __table_args__ = (
+        db.Index('ix_stripe_event_pending', 'processed_at', 'received_at'),
+    )
+
+
+# Database model for background jobs, e.g. creating a product and its price in Stripe
+class Job(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    type = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded or failed
+    payload = db.Column(db.JSON, nullable=False)  # Input of the job
+    progress = db.Column(db.JSON, nullable=False, default={})  # Results of the steps done so far
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)  # Error of the last attempt
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # Queued: next attempt, running: lease end
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+
+# Database model for responses to requests with an Idempotency-Key header
+class IdempotencyRecord(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False)  # Idempotency-Key header
+    user_id = db.Column(db.String(36), nullable=False, default='')  # Empty for requests without a user yet
+    request_hash = db.Column(db.String(64), nullable=False)  # Method, path and body, a key can't be reused
+    status_code = db.Column(db.Integer)  # None while the first request is running
+    response_body = db.Column(db.Text)
+    mimetype = db.Column(db.String(100))
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # Lease end while running, then replay end
+
+    __table_args__ = (
+        db.Index('ix_idempotency_record_key_user', 'key', 'user_id', unique=True),
+    )
+
+
+# Database model for the local copy of the Stripe products
+class Product(db.Model):
+    id = db.Column(db.String(64), primary_key=True)  # Stripe product ID
+    name = db.Column(db.String(250), nullable=False)
+    description = db.Column(db.Text)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    metadata_ = db.Column('metadata', db.JSON, default={})
+    created = db.Column(db.Integer, nullable=False)  # Unix timestamp from Stripe
+    updated = db.Column(db.Integer)  # Unix timestamp from Stripe
+
+    __table_args__ = (
+        db.Index('ix_product_active_created', 'active', 'created', 'id'),
+        db.Index('ix_product_name', 'name'),
+    )
+
+
+# Database model for the local copy of the Stripe prices
+class Price(db.Model):
+    id = db.Column(db.String(64), primary_key=True)  # Stripe price ID
+    product_id = db.Column(db.String(64), db.ForeignKey('product.id'), nullable=False, index=True)
+    unit_amount = db.Column(db.Integer)  # Amount in the smallest currency unit
+    currency = db.Column(db.String(3), nullable=False)
+    recurring_interval = db.Column(db.String(10))  # None for one-time prices
+    tax_behavior = db.Column(db.String(20))
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created = db.Column(db.Integer, nullable=False)  # Unix timestamp from Stripe
+
+
+# Database model for the state of the catalog sync (single row)
+class CatalogSyncState(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    last_event_id = db.Column(db.String(64))  # Newest Stripe event that was applied
+    last_event_created = db.Column(db.Integer, nullable=False)  # Unix timestamp of that event
+    last_full_sync = db.Column(db.DateTime, nullable=False)
+    last_sync = db.Column(db.DateTime, nullable=False)
+
+
+# In-memory cache of the Stripe product list
+catalog_cache = CatalogCache(
+    lambda: _load_stripe_catalog(),
+    ttl=product_cache_ttl,
+    max_stale=product_cache_max_stale,
+    on_error=lambda e: LogSystem.log_error("product_cache_refresh_failed", error=str(e))
+)
+
+
+def backfill_opening_balances():
+    """
+    Makes the ledger of balances from before the ledger existed add up: users without
+    ledger entries get an "opening_balance" entry with their coins, users whose first
+    entry started from a balance other than 0 get a snapshot at that entry. Users that
+    were handled before are skipped, so it's safe to run on every start.
+    """
+    now = datetime.utcnow()
+    has_entries = db.exists().where(CoinTransaction.user_id == User.id)
+    opened = db.session.execute(db.insert(CoinTransaction).from_select(
+        ['user_id', 'amount', 'balance', 'reason', 'created_at'],
+        db.select(User.id, User.coins, User.coins, db.literal('opening_balance'), db.literal(now)).where(
+            db.func.coalesce(User.coins, 0) != 0, ~has_entries)
+    )).rowcount
+    first_entries = db.select(CoinTransaction.user_id, db.func.min(CoinTransaction.id).label('id')).group_by(
+        CoinTransaction.user_id).subquery()
+    has_snapshot = db.exists().where(CoinSnapshot.user_id == CoinTransaction.user_id)
+    anchored = db.session.execute(db.insert(CoinSnapshot).from_select(
+        ['user_id', 'transaction_id', 'balance', 'created_at'],
+        db.select(CoinTransaction.user_id, CoinTransaction.id, CoinTransaction.balance, db.literal(now)).join(
+            first_entries, first_entries.c.id == CoinTransaction.id).where(
+            CoinTransaction.balance != CoinTransaction.amount, ~has_snapshot)
+    )).rowcount
+    db.session.commit()
+    if opened or anchored:
+        LogSystem.log_info("opening_balances_backfilled", entries=opened, snapshots=anchored)
+    return opened + anchored
+
 
 # Create tables if not exist
 with app.app_context():
     db.create_all()
-    LogSystem.log_info("Database tables created")
+    # create_all() doesn't add columns to tables which already exist
+    for table, column, definition in [('user', 'version', 'INTEGER NOT NULL DEFAULT 0'),
+                                      ('user', 'created_at', 'TIMESTAMP'),
+                                      ('stripe_event', 'attempts', 'INTEGER NOT NULL DEFAULT 0'),
+                                      ('stripe_event', 'next_attempt_at', 'TIMESTAMP')]:
+        if column not in {existing['name'] for existing in db.inspect(db.engine).get_columns(table)}:
+            with db.engine.begin() as connection:
+                connection.execute(db.text(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}'))
+    # create_all() skips indexes that were added to tables which already exist
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    LogSystem.log_info("database_tables_created")
+    # Balances from before the coin ledger existed
+    backfill_opening_balances()
+
+
+# Catalog sync with Stripe
+CATALOG_EVENT_TYPES = ['product.created', 'product.updated', 'product.deleted',
+                       'price.created', 'price.updated', 'price.deleted']
+STRIPE_EVENT_RETENTION = 30 * 24 * 3600  # Stripe only lists events of the last 30 days
+
+catalog_mirror_ready = False  # True once the local catalog has been filled
+
+
+def _stripe_call(operation, func, *args, **kwargs):
+    # Every Stripe API call goes through here so that its duration is measured
+    with metrics.timer(stripe_seconds, operation=operation):
+        return func(*args, **kwargs)
+
+
+def _stripe_call_with_retry(operation, func, *args, **kwargs):
+    # Like _stripe_call, but retries with exponential backoff (and jitter, so parallel callers
+    # spread out) when Stripe answers with a rate limit error
+    for attempt in range(stripe_rate_limit_retries + 1):
+        try:
+            return _stripe_call(operation, func, *args, **kwargs)
+        except stripe.RateLimitError:
+            if attempt == stripe_rate_limit_retries:
+                raise
+            stripe_rate_limited_total.inc(operation=operation)
+            time.sleep(stripe_rate_limit_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def _to_dict(stripe_object):
+    # StripeObject is a dict subclass only in older versions of the library
+    if stripe_object is None:
+        return None
+    if hasattr(stripe_object, 'to_dict'):
+        return stripe_object.to_dict()
+    return dict(stripe_object)
+
+
+def _stripe_list(resource, **params):
+    # Iterate over all pages of a Stripe list using starting_after
+    params['limit'] = 100
+    while True:
+        page = _stripe_call(f"{resource.OBJECT_NAME}_list", resource.list, **params)
+        yield from page.data
+        if not page.has_more or not page.data:
+            break
+        params['starting_after'] = page.data[-1]['id']
+
+
+def _product_from_stripe(obj):
+    return Product(
+        id=obj['id'],
+        name=obj['name'],
+        description=obj['description'],
+        active=obj['active'],
+        metadata_=_to_dict(obj['metadata']) or {},
+        created=obj['created'],
+        updated=obj['updated']
+    )
+
+
+def _price_from_stripe(obj):
+    recurring = obj['recurring']
+    return Price(
+        id=obj['id'],
+        product_id=obj['product'],
+        unit_amount=obj['unit_amount'],
+        currency=obj['currency'],
+        recurring_interval=recurring['interval'] if recurring else None,
+        tax_behavior=obj['tax_behavior'],
+        active=obj['active'],
+        created=obj['created']
+    )
+
+
+def _upsert_product(obj):
+    db.session.merge(_product_from_stripe(obj))
+
+
+def _upsert_price(obj):
+    # Prices of products that are not in the local catalog are skipped
+    if not Product.query.get(obj['product']):
+        return False
+    db.session.merge(_price_from_stripe(obj))
+    return True
+
+
+def _full_catalog_sync():
+    # Remember the newest event first so that changes made during the sync are replayed afterwards
+    newest_events = _stripe_call('event_list', stripe.Event.list, limit=1, types=CATALOG_EVENT_TYPES).data
+    last_event = newest_events[0] if newest_events else None
+
+    product_ids = set()
+    for obj in _stripe_list(stripe.Product):
+        _upsert_product(obj)
+        product_ids.add(obj['id'])
+    db.session.flush()
+
+    price_ids = set()
+    for obj in _stripe_list(stripe.Price):
+        if _upsert_price(obj):
+            price_ids.add(obj['id'])
+
+    # Remove what no longer exists in Stripe
+    Price.query.filter(Price.id.notin_(price_ids)).delete(synchronize_session=False)
+    Price.query.filter(Price.product_id.notin_(product_ids)).delete(synchronize_session=False)
+    Product.query.filter(Product.id.notin_(product_ids)).delete(synchronize_session=False)
+    return last_event, len(product_ids) + len(price_ids)
+
+
+def _apply_catalog_event(event):
+    obj = event['data']['object']
+    if event['type'] == 'product.deleted':
+        Price.query.filter_by(product_id=obj['id']).delete(synchronize_session=False)
+        Product.query.filter_by(id=obj['id']).delete(synchronize_session=False)
+    elif event['type'] == 'price.deleted':
+        Price.query.filter_by(id=obj['id']).delete(synchronize_session=False)
+    elif event['type'].startswith('product.'):
+        _upsert_product(obj)
+    else:
+        db.session.flush()
+        _upsert_price(obj)
+
+
+def _incremental_catalog_sync(state):
+    params = {'limit': 100, 'types': CATALOG_EVENT_TYPES}
+    if not state.last_event_id:
+        # No event cursor yet: page backwards through the whole window with starting_after
+        # (the first page holds the newest events), then apply all of them oldest first
+        params['created'] = {'gte': state.last_event_created}
+        events = []
+        while True:
+            page = _stripe_call('event_list', stripe.Event.list, **params)
+            events.extend(page.data)
+            if not page.has_more or not page.data:
+                break
+            params['starting_after'] = page.data[-1]['id']
+        for event in reversed(events):
+            _apply_catalog_event(event)
+        return (events[0] if events else None), len(events)
+
+    # Page towards newer events with ending_before, each page is listed newest first
+    last_event = None
+    changes = 0
+    params['ending_before'] = state.last_event_id
+    while True:
+        page = _stripe_call('event_list', stripe.Event.list, **params)
+        for event in reversed(page.data):
+            _apply_catalog_event(event)
+            changes += 1
+        if page.data:
+            last_event = page.data[0]
+            params['ending_before'] = last_event['id']
+        if not page.has_more:
+            break
+    return last_event, changes
+
+
+def sync_catalog(full=False):
+    """
+    Syncs the local Product and Price tables with Stripe. The first sync loads the
+    whole catalog, later syncs only apply the catalog events since the last sync.
+    """
+    global catalog_mirror_ready
+    state = CatalogSyncState.query.get(1)
+    now = datetime.utcnow()
+    full = full or not state or time.time() - state.last_event_created >= STRIPE_EVENT_RETENTION
+    if full:
+        last_event, changes = _full_catalog_sync()
+        if not state:
+            state = CatalogSyncState(id=1)
+            db.session.add(state)
+        state.last_full_sync = now
+        state.last_event_id = last_event['id'] if last_event else None
+        state.last_event_created = last_event['created'] if last_event else int(time.time())
+    else:
+        started = int(time.time())
+        last_event, changes = _incremental_catalog_sync(state)
+        if last_event:
+            state.last_event_id = last_event['id']
+            state.last_event_created = last_event['created']
+        else:
+            # Nothing changed: the next sync lists the events from now on (created[gte]), so a quiet
+            # catalog doesn't age past STRIPE_EVENT_RETENTION and cause a full sync every time
+            state.last_event_id = None
+            state.last_event_created = started
+    state.last_sync = now
+    db.session.commit()
+    catalog_mirror_ready = True
+    catalog_cache.invalidate()
+    LogSystem.log_info("catalog_synced", full=full, changes=changes)
+
+
+def _sync_catalog_task():
+    with app.app_context():
+        sync_catalog()
+
+
+catalog_sync_task = PeriodicTask(
+    _sync_catalog_task,
+    catalog_sync_interval,
+    on_error=lambda e: LogSystem.log_error("catalog_sync_failed", error=str(e))
+)
+
+
+def _catalog_mirror_ready():
+    # Keep the local catalog up to date and tell whether it has been filled yet
+    global catalog_mirror_ready
+    catalog_sync_task.trigger()
+    if not catalog_mirror_ready:
+        catalog_mirror_ready = CatalogSyncState.query.get(1) is not None
+    return catalog_mirror_ready
+
+
+@app.cli.command('sync-catalog')
+def sync_catalog_command():
+    """Syncs the local product catalog with Stripe."""
+    sync_catalog()
+
+
+def _price_to_dict(price):
+    return {
+        'id': price.id,
+        'unit_amount': price.unit_amount,
+        'currency': price.currency,
+        'recurring': {'interval': price.recurring_interval} if price.recurring_interval else None,
+        'tax_behavior': price.tax_behavior,
+        'active': price.active
+    }
+
+
+def _product_to_dict(product, prices):
+    return {
+        'id': product.id,
+        'name': product.name,
+        'description': product.description,
+        'active': product.active,
+        'metadata': product.metadata_ or {},
+        'created': product.created,
+        'prices': [_price_to_dict(price) for price in prices]
+    }
+
+
+def _load_stripe_catalog():
+    # The whole Stripe catalog in the shape of the local one, newest first, until the local catalog is filled
+    prices = {}
+    for obj in sorted(_stripe_list(stripe.Price), key=lambda price: price['created']):
+        prices.setdefault(obj['product'], []).append(_price_from_stripe(obj))
+    products = sorted(_stripe_list(stripe.Product), key=lambda product: (product['created'], product['id']),
+                      reverse=True)
+    return [_product_to_dict(_product_from_stripe(obj), prices.get(obj['id'], [])) for obj in products]
+
+
+def _list_cached_products(products, args):
+    # The same filters and pagination as _list_local_products() on the cached Stripe catalog
+    limit = min(max(int(args.get('limit', 20)), 1), 100)
+    if args.get('starting_after'):
+        cursor = next((p for p in products if p['id'] == args['starting_after']), None)
+        if cursor:
+            products = [p for p in products if (p['created'], p['id']) < (cursor['created'], cursor['id'])]
+    if args.get('active', 'true').lower() != 'all':
+        products = [p for p in products if p['active'] == (args.get('active', 'true').lower() == 'true')]
+    if args.get('q'):
+        products = [p for p in products if args['q'].lower() in p['name'].lower()]
+    if args.get('currency'):
+        products = [p for p in products if any(
+            price['currency'] == args['currency'].lower() and price['active'] for price in p['prices'])]
+    return {'products': products[:limit], 'has_more': len(products) > limit}
+
+
+def _list_local_products(args):
+    # Filtering and keyset pagination (newest first, like Stripe) on the local catalog
+    limit = min(max(int(args.get('limit', 20)), 1), 100)
+    query = Product.query
+    if args.get('active', 'true').lower() != 'all':
+        query = query.filter(Product.active == (args.get('active', 'true').lower() == 'true'))
+    if args.get('q'):
+        query = query.filter(Product.name.ilike(f"%{args['q']}%"))
+    if args.get('currency'):
+        query = query.filter(Product.id.in_(
+            db.session.query(Price.product_id).filter(Price.currency == args['currency'].lower(), Price.active)))
+    if args.get('starting_after'):
+        cursor = Product.query.get(args['starting_after'])
+        if cursor:
+            query = query.filter(db.tuple_(Product.created, Product.id) < (cursor.created, cursor.id))
+    products = query.order_by(Product.created.desc(), Product.id.desc()).limit(limit + 1).all()
+    has_more = len(products) > limit
+    products = products[:limit]
+
+    prices = {}
+    if products:
+        for price in Price.query.filter(Price.product_id.in_([p.id for p in products])).order_by(Price.created):
+            prices.setdefault(price.product_id, []).append(price)
+    return {
+        'products': [_product_to_dict(p, prices.get(p.id, [])) for p in products],
+        'has_more': has_more
+    }
+
+
+# Request logging and metrics
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.query_seconds = 0.0
+    g.query_statements = Counter()
+    requests_in_flight.inc()
+
+
+def _body_field(name):
+    # A field of the JSON body for the logs of error paths, None if the body isn't a JSON object
+    body = request.get_json(silent=True)
+    return body.get(name) if isinstance(body, dict) else None
+
+
+@app.after_request
+def log_request(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    latency = time.perf_counter() - g.request_started
+    request_seconds.observe(latency, method=request.method, route=route)
+    requests_total.inc(method=request.method, route=route, status=response.status_code)
+    _report_queries(route, response)
+
+    body = request.get_json(silent=True) if request.is_json else None
+    LogSystem.log_info(
+        "request",
+        method=request.method,
+        route=request.url_rule.rule if request.url_rule else request.path,
+        status=response.status_code,
+        latency_ms=round(latency * 1000, 2),
+        user_id=request.args.get('user_id') or (body.get('user_id') if isinstance(body, dict) else None)
+    )
+    return response
+
+
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings, min_size=compression_min_size)
+
+
+@app.teardown_request
+def end_request(exception):
+    if 'request_started' in g:
+        requests_in_flight.dec()
+
+
+@db.event.listens_for(db.session, 'before_commit')
+def start_commit_timer(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def observe_commit(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        db_commit_seconds.observe(time.perf_counter() - started)
+
+
+# SQL query timing
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_started'].pop()
+    db_query_seconds.observe(duration)
+    if has_request_context() and 'query_statements' in g:
+        g.query_count += 1
+        g.query_seconds += duration
+        g.query_statements[statement] += 1
+    if duration * 1000 >= slow_query_threshold_ms:
+        SlowQueryLog.log_warning(
+            "slow_query",
+            duration_ms=round(duration * 1000, 2),
+            statement=statement,  # Parameters are left out, they can contain secrets
+            route=request.url_rule.rule if has_request_context() and request.url_rule else None,
+            plan=None if executemany else _query_plan(conn, cursor, statement, parameters)
+        )
+
+
+def _query_failed(exception_context):
+    if exception_context.connection is not None and exception_context.connection.info.get('query_started'):
+        exception_context.connection.info['query_started'].pop()
+
+
+def _query_plan(conn, cursor, statement, parameters):
+    # Runs EXPLAIN on the raw DBAPI connection, so it doesn't show up in the query events
+    if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+        return None
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    try:
+        explain = cursor.connection.cursor()
+        try:
+            explain.execute(prefix + statement, parameters)
+            return [' '.join(str(column) for column in row) for row in explain.fetchall()]
+        finally:
+            explain.close()
+    except Exception as e:
+        return f"Plan not available: {str(e)}"
+
+
+with app.app_context():
+    db.event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+    db.event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+    db.event.listen(db.engine, 'handle_error', _query_failed)
+
+
+def _report_queries(route, response):
+    # Per request summary: metrics, N+1 warnings and, in debug mode, response headers
+    if 'query_statements' not in g:
+        return
+    db_queries_per_request.observe(g.query_count)
+    for statement, count in g.query_statements.items():
+        if count >= n_plus_one_threshold:
+            LogSystem.log_warning("n_plus_one_suspected", route=route, statement=statement, count=count)
+    if app.debug:
+        response.headers['X-Query-Count'] = str(g.query_count)
+        response.headers['X-Query-Time-Ms'] = f"{g.query_seconds * 1000:.2f}"
+
+
+def _cache_metrics():
+    stats = catalog_cache.stats()
+    return [
+        ('shop_product_cache_hits_total', 'counter', 'Product cache hits', stats['hits']),
+        ('shop_product_cache_stale_hits_total', 'counter', 'Product cache hits on a stale value', stats['stale_hits']),
+        ('shop_product_cache_misses_total', 'counter', 'Product cache misses', stats['misses']),
+        ('shop_product_cache_refresh_seconds_total', 'counter', 'Time spent refreshing the product cache',
+         stats['refresh_seconds_total']),
+        ('shop_auth_cache_hits_total', 'counter', 'Secret checks answered from the cache', auth_cache.hits),
+        ('shop_auth_cache_misses_total', 'counter', 'Secret checks that needed a query', auth_cache.misses),
+        ('shop_webhook_queue_size', 'gauge', 'Webhook events waiting for the worker', webhook_worker.queue.qsize()),
+        ('shop_password_hash_pending', 'gauge', 'Hash operations queued or running', password_hasher.pending),
+        ('shop_log_records_dropped_total', 'counter', 'Log records dropped because the log queue was full',
+         LogSystem.dropped)
+    ]
+
+
+metrics.add_collector(_cache_metrics)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Accounts
+password_hasher = PasswordHasher(method=password_hash_method, workers=password_hash_workers,
+                                 max_pending=password_hash_max_pending)
+login_username_limiter = TokenBucketLimiter(login_rate_per_username / 60, login_burst_per_username)
+login_ip_limiter = TokenBucketLimiter(login_rate_per_ip / 60, login_burst_per_ip)
+
+
+def _hash_password(password):
+    with metrics.timer(password_hash_seconds, operation='hash'):
+        return password_hasher.hash(password)
+
+
+def _check_password(password_hash, password):
+    with metrics.timer(password_hash_seconds, operation='check'):
+        return password_hasher.check(password_hash, password)
+
+
+def _rate_limited(username=None):
+    """
+    Takes an attempt from the buckets of the client IP and the username. Returns a 429
+    response if one of them is empty, otherwise None.
+    """
+    wait = login_ip_limiter.take(request.remote_addr)
+    if username is not None:
+        wait = max(wait, login_username_limiter.take(username))
+    if not wait:
+        return None
+    login_rejected_total.inc(reason='rate_limited')
+    LogSystem.log_warning("rate_limited", route=request.url_rule.rule if request.url_rule else request.path,
+                          ip=request.remote_addr, username=username)
+    return jsonify({'error': 'Too many attempts, try again later'}), 429, {'Retry-After': str(math.ceil(wait))}
+
+
+def _idempotency_replay(user_id=''):
+    """
+    For requests with an Idempotency-Key header: returns the stored response if the key was
+    used before by the same user, an error if that request is still running or was a
+    different one, and otherwise reserves the key and returns None. Routes that change
+    data store their response with _idempotent_response() in the same transaction as the
+    change, all other responses are stored by store_idempotent_response(). A reservation
+    is never taken over by a retry, a request that crashed before storing its response
+    keeps answering 409 until the key expires.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return None
+    if len(key) > 255:
+        return jsonify({'error': 'Idempotency-Key too long'}), 400
+    request_hash = hashlib.sha256(
+        request.method.encode() + b' ' + request.path.encode() + b' ' + request.get_data()).hexdigest()
+    now = datetime.utcnow()
+
+    record = IdempotencyRecord.query.filter_by(key=key, user_id=user_id).first()
+    if record and record.expires_at <= now:
+        db.session.delete(record)
+        db.session.commit()
+        record = None
+    if record is None:
+        db.session.add(IdempotencyRecord(key=key, user_id=user_id, request_hash=request_hash,
+                                         expires_at=now + timedelta(seconds=idempotency_key_ttl)))
+        try:
+            db.session.commit()
+        except IntegrityError:  # A request with the same key came in at the same time
+            db.session.rollback()
+            return jsonify({'error': 'A request with this Idempotency-Key is in progress'}), 409
+        g.idempotency_key = (key, user_id)
+        return None
+
+    if record.request_hash != request_hash:
+        return jsonify({'error': 'Idempotency-Key was used for a different request'}), 422
+    if record.status_code is None:
+        return jsonify({'error': 'A request with this Idempotency-Key is in progress'}), 409, {'Retry-After': '1'}
+    LogSystem.log_info("idempotent_replay", route=request.path, user_id=user_id or None)
+    response = Response(record.response_body, status=record.status_code, mimetype=record.mimetype)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _idempotent_response(response):
+    """
+    Turns the return value of a route into a response and, for a request with an
+    Idempotency-Key, adds it to the reservation of the key. The caller commits it together
+    with its changes, so a retry finds either both or neither.
+    """
+    response = make_response(response)
+    if 'idempotency_key' in g:
+        key, user_id = g.idempotency_key
+        IdempotencyRecord.query.filter_by(key=key, user_id=user_id).update(
+            {'status_code': response.status_code, 'response_body': response.get_data(as_text=True),
+             'mimetype': response.mimetype, 'expires_at': datetime.utcnow() + timedelta(seconds=idempotency_key_ttl)})
+    return response
+
+
+@app.after_request
+def store_idempotent_response(response):
+    # Registered after compress(), so it runs before it and stores the uncompressed body
+    if 'idempotency_key' not in g:
+        return response
+    key, user_id = g.pop('idempotency_key')
+    db.session.rollback()  # Whatever the request left uncommitted
+    # A response stored together with the changes of the request stays, even if the request failed afterwards
+    records = IdempotencyRecord.query.filter_by(key=key, user_id=user_id, status_code=None)
+    if response.status_code >= 500 or response.status_code in (408, 429):
+        records.delete()  # Server errors, timeouts and rate limits may be retried with the same key
+    else:
+        records.update({'status_code': response.status_code, 'response_body': response.get_data(as_text=True),
+                        'mimetype': response.mimetype,
+                        'expires_at': datetime.utcnow() + timedelta(seconds=idempotency_key_ttl)})
+    db.session.commit()
+    idempotency_purge_task.trigger()
+    return response
+
+
+def purge_idempotency_records():
+    """Deletes expired idempotency keys in batches, each in its own short transaction."""
+    deleted = 0
+    while True:
+        expired = db.session.query(IdempotencyRecord.id).filter(
+            IdempotencyRecord.expires_at < datetime.utcnow()).limit(idempotency_purge_batch)
+        count = IdempotencyRecord.query.filter(IdempotencyRecord.id.in_(expired.scalar_subquery())).delete(
+            synchronize_session=False)
+        db.session.commit()
+        deleted += count
+        if count < idempotency_purge_batch:
+            break
+    if deleted:
+        LogSystem.log_info("idempotency_keys_purged", deleted=deleted)
+    return deleted
+
+
+def _purge_idempotency_task():
+    with app.app_context():
+        purge_idempotency_records()
+
+
+idempotency_purge_task = PeriodicTask(
+    _purge_idempotency_task,
+    idempotency_purge_interval,
+    on_error=lambda e: LogSystem.log_error("idempotency_purge_failed", error=str(e))
+)
+
+
+def _is_admin():
+    # Admin endpoints need the X-Admin-Key header, they are disabled while key.admin_api_key is empty
+    return bool(key.admin_api_key) and hmac.compare_digest(request.headers.get('X-Admin-Key', ''),
+                                                           key.admin_api_key)
+
+
+def _hasher_busy():
+    login_rejected_total.inc(reason='busy')
+    LogSystem.log_warning("password_hasher_busy", pending=password_hasher.pending)
+    return jsonify({'error': 'Server busy, try again later'}), 503, {'Retry-After': '1'}
+
+
+# Cache of (secret, username) by user ID for the authentication checks
+auth_cache = LRUCache(max_size=auth_cache_size, ttl=auth_cache_ttl)
+
+
+@db.event.listens_for(User, 'after_update')
+def _invalidate_auth_cache_on_update(mapper, connection, target):
+    state = db.inspect(target)
+    if state.attrs.secret.history.has_changes() or state.attrs.username.history.has_changes():
+        auth_cache.invalidate(target.id)
+
+
+@db.event.listens_for(User, 'after_delete')
+def _invalidate_auth_cache_on_delete(mapper, connection, target):
+    auth_cache.invalidate(target.id)
+
+
+def _load_auth(user_ids):
+    """
+    Returns {user_id: (secret, username)} for the given users that exist, taking
+    cached entries from auth_cache and loading the rest with one query.
+    """
+    found = {}
+    missing = []
+    for user_id in user_ids:
+        entry = auth_cache.get(user_id)
+        if entry is None:
+            missing.append(user_id)
+        else:
+            found[user_id] = entry
+    if missing:
+        for user_id, secret, username in db.session.query(User.id, User.secret, User.username).filter(
+                User.id.in_(missing)):
+            found[user_id] = (secret, username)
+            auth_cache.set(user_id, (secret, username))
+    return found
+
+
+def _check_secret(user_id, secret):
+    # Compare the secret without loading the user, usually without a query at all
+    entry = _load_auth([user_id]).get(user_id)
+    return entry is not None and secret is not None and entry[0] == secret
+
+
+def _configured_secret(value, prefix='', min_length=1):
+    # A secret from key.py, or None while it is empty, the placeholder text or doesn't look like one
+    if not isinstance(value, str) or value.startswith('Paste') or not value.startswith(prefix) \
+            or len(value) < min_length:
+        return None
+    return value
+
+
+# Signed access and refresh tokens, disabled until key.token_signing_key is set
+token_signer = TokenSigner(_configured_secret(key.token_signing_key, min_length=32), access_ttl=access_token_ttl,
+                           refresh_ttl=refresh_token_ttl)
+token_revocations = RevocationList(
+    lambda: db.session.query(TokenRevocation.user_id, TokenRevocation.revoked_before).filter(
+        TokenRevocation.revoked_before > time.time() - refresh_token_ttl).all(),
+    refresh_interval=token_revocation_refresh
+)
+
+
+def _verify_token(token, token_type='access'):
+    payload = token_signer.verify(token, token_type)
+    if not payload or token_revocations.is_revoked(payload):
+        return None
+    return payload
+
+
+def _issue_tokens(user_id):
+    if not token_signer.enabled:
+        return {}
+    return {
+        'access_token': token_signer.issue(user_id, 'access'),
+        'refresh_token': token_signer.issue(user_id, 'refresh'),
+        'token_type': 'Bearer',
+        'expires_in': access_token_ttl
+    }
+
+
+def revoke_tokens(user_id):
+    """
+    Invalidates all access and refresh tokens issued to the user so far and replaces the
+    secret, so a forced logout also ends the sessions that use the secret. The new one
+    comes with the next login; other processes drop the old one from their auth_cache
+    within auth_cache_ttl seconds.
+    """
+    now = time.time()
+    db.session.merge(TokenRevocation(user_id=user_id, revoked_before=now))
+    db.session.execute(db.update(User).where(User.id == user_id).values(secret=_new_user_id()))
+    db.session.commit()
+    token_revocations.revoke(user_id, now)
+    auth_cache.invalidate(user_id)
+
+
+def _authenticate(user_id, secret):
+    """
+    Returns the ID of the authenticated user or None. With an "Authorization: Bearer"
+    header the access token decides (user_id, if given, must match it), otherwise the
+    secret of the user.
+    """
+    header = request.headers.get('Authorization')
+    if header is not None:
+        payload = _verify_token(header[len('Bearer '):]) if header.startswith('Bearer ') else None
+        if not payload or (user_id and user_id != payload['sub']):
+            return None
+        return payload['sub']
+    if user_id and _check_secret(user_id, secret):
+        return user_id
+    return None
+
+
+def _valid_amount(amount):
+    return isinstance(amount, int) and not isinstance(amount, bool) and amount > 0
+
+
+def _change_coins(user_id, action, amount, reason=None):
+    """
+    Adds or deducts coins with a single conditional UPDATE, so concurrent requests can
+    neither lose updates nor overdraw the balance, and writes the change to the ledger.
+    Returns the new balance, or None if there are not enough coins. The caller commits.
+    """
+    coins = db.func.coalesce(User.coins, 0)
+    if action == 'add':
+        statement = db.update(User).where(User.id == user_id).values(coins=coins + amount, version=User.version + 1)
+    else:
+        statement = db.update(User).where(User.id == user_id, coins >= amount).values(coins=coins - amount,
+                                                                                      version=User.version + 1)
+    statement = statement.returning(User.coins).execution_options(synchronize_session=False)
+    balance = db.session.execute(statement).scalar()
+    if balance is not None:
+        db.session.add(CoinTransaction(
+            user_id=user_id,
+            amount=amount if action == 'add' else -amount,
+            balance=balance,
+            reason=reason or action
+        ))
+    return balance
+
+
+def _update_user_data(user_id, values, increments):
+    """
+    Sets the keys in `values` and adds the numbers in `increments` to the keys of the
+    user's JSON data in a single UPDATE (json_set on SQLite, jsonb_set on PostgreSQL).
+    Only the given keys change, concurrent updates of other keys or increments of the
+    same key are not lost. Returns the new data, or None if the user doesn't exist.
+    The caller commits.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        current = db.func.coalesce(db.cast(User.data, JSONB), db.literal({}, JSONB))
+        data = current.op('||')(db.literal(values, JSONB))
+        for name, amount in increments.items():
+            number = db.func.coalesce(db.cast(current.op('->>')(db.literal(name, db.Text)), db.Numeric), 0) + amount
+            data = db.func.jsonb_set(data, db.literal([name], ARRAY(db.Text)), db.func.to_jsonb(number))
+        data = db.cast(data, db.JSON)
+    else:
+        arguments = []
+        for name, value in values.items():
+            arguments += [f'$."{name}"', db.func.json(json.dumps(value))]
+        for name, amount in increments.items():
+            arguments += [f'$."{name}"', db.func.coalesce(db.func.json_extract(User.data, f'$."{name}"'), 0) + amount]
+        data = db.func.json_set(db.func.coalesce(User.data, '{}'), *arguments)
+    statement = db.update(User).where(User.id == user_id).values(data=data, version=User.version + 1).returning(
+        User.data).execution_options(synchronize_session=False)
+    return db.session.execute(statement).scalar()
+
+
+def _conditional_response(user_id, version, build):
+    """
+    Answers with 304 Not Modified if the client sent the current ETag of the user in
+    If-None-Match, otherwise with the response from build(). The ETag changes with the
+    user's version, which every change of coins, data or purchases increments.
+    """
+    etag = f"{user_id}-{version}"
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'  # Clients have to revalidate
+    return response
+
+
+def _encode_cursor(timestamp, row_id):
+    # Keyset pagination cursor for lists ordered by (timestamp, id)
+    return f"{timestamp.isoformat()}|{row_id}"
+
+
+def _decode_cursor(cursor):
+    timestamp, row_id = cursor.rsplit('|', 1)
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+
+def _list_purchases(user_id, limit, cursor=None):
+    # Purchases of a user, newest first, loaded as column tuples with keyset pagination
+    query = db.session.query(PurchaseHistory.id, PurchaseHistory.product_name, PurchaseHistory.purchase_date).filter(
+        PurchaseHistory.user_id == user_id)
+    if cursor:
+        purchase_date, purchase_id = _decode_cursor(cursor)
+        query = query.filter(db.tuple_(PurchaseHistory.purchase_date, PurchaseHistory.id) < (purchase_date, purchase_id))
+    rows = query.order_by(PurchaseHistory.purchase_date.desc(), PurchaseHistory.id.desc()).limit(limit + 1).all()
+    next_cursor = _encode_cursor(rows[limit - 1].purchase_date, rows[limit - 1].id) if len(rows) > limit else None
+    return [
+        {
+            'product_name': row.product_name,
+            'purchase_date': row.purchase_date.isoformat()
+        } for row in rows[:limit]
+    ], next_cursor
+
+
+# Coin snapshots
+def snapshot_coin_balances():
+    """
+    Writes a snapshot for every user with at least coin_snapshot_min_transactions
+    ledger entries since their last snapshot.
+    """
+    last_snapshots = db.session.query(
+        CoinSnapshot.user_id, db.func.max(CoinSnapshot.transaction_id).label('transaction_id')
+    ).group_by(CoinSnapshot.user_id).subquery()
+    pending = db.session.query(
+        CoinTransaction.user_id, db.func.max(CoinTransaction.id)
+    ).outerjoin(
+        last_snapshots, last_snapshots.c.user_id == CoinTransaction.user_id
+    ).filter(
+        CoinTransaction.id > db.func.coalesce(last_snapshots.c.transaction_id, 0)
+    ).group_by(CoinTransaction.user_id).having(
+        db.func.count(CoinTransaction.id) >= coin_snapshot_min_transactions
+    ).all()
+
+    transaction_ids = [transaction_id for _, transaction_id in pending]
+    for transaction in CoinTransaction.query.filter(CoinTransaction.id.in_(transaction_ids)):
+        db.session.add(CoinSnapshot(user_id=transaction.user_id, transaction_id=transaction.id,
+                                    balance=transaction.balance))
+    db.session.commit()
+    LogSystem.log_info("coin_snapshots_written", count=len(transaction_ids))
+    return len(transaction_ids)
+
+
+def rebuild_coin_balance(user_id):
+    """Rebuilds the balance of a user from the last snapshot and the ledger entries after it."""
+    snapshot = CoinSnapshot.query.filter_by(user_id=user_id).order_by(CoinSnapshot.transaction_id.desc()).first()
+    start_balance, start_id = (snapshot.balance, snapshot.transaction_id) if snapshot else (0, 0)
+    tail = db.session.query(db.func.coalesce(db.func.sum(CoinTransaction.amount), 0)).filter(
+        CoinTransaction.user_id == user_id, CoinTransaction.id > start_id).scalar()
+    return start_balance + tail
+
+
+def _snapshot_coins_task():
+    with app.app_context():
+        snapshot_coin_balances()
+
+
+coin_snapshot_task = PeriodicTask(
+    _snapshot_coins_task,
+    coin_snapshot_interval,
+    on_error=lambda e: LogSystem.log_error("coin_snapshots_failed", error=str(e))
+)
+
+
+@app.cli.command('snapshot-coins')
+def snapshot_coins_command():
+    """Writes coin balance snapshots."""
+    snapshot_coin_balances()
+
+
+@app.cli.command('verify-coins')
+def verify_coins_command():
+    """Compares every balance with the balance rebuilt from snapshots and the ledger."""
+    mismatches = 0
+    for user_id, coins in db.session.query(User.id, User.coins):
+        rebuilt = rebuild_coin_balance(user_id)
+        if rebuilt != (coins or 0):
+            mismatches += 1
+            click.echo(f"User '{user_id}': Balance={coins}, Rebuilt={rebuilt}")
+    click.echo(f"Balances with mismatches: {mismatches}")
 
 
 @app.route('/')
@@ -51,54 +1212,711 @@ def index():
             }
 
 
+def _create_stripe_product(data, idempotency_key=None):
+    """
+    Creates a product and its price in Stripe and returns both. With an idempotency key
+    a repeated call returns the objects of the first call instead of creating new ones.
+    """
+    new_product = _create_stripe_product_only(data, idempotency_key)
+    return new_product, _create_stripe_price(data, new_product['id'], idempotency_key)
+
+
+def _create_stripe_product_only(data, idempotency_key=None):
+    # Create product in Stripe
+    new_product = _stripe_call_with_retry(
+        'product_create', stripe.Product.create,
+        name=data['name'],
+        description=data.get('description', ''),
+        metadata=data.get('metadata', {}),
+        **({'idempotency_key': f"{idempotency_key}-product"} if idempotency_key else {})
+    )
+    LogSystem.log_info("product_created", product_id=new_product['id'], name=new_product['name'])
+    return new_product
+
+
+def _create_stripe_price(data, product_id, idempotency_key=None):
+    # Convert price and set required fields
+    price_data = {
+        "unit_amount": round(data['price'] * 100),  # int() would make 16.99 into 1698 cents
+        "currency": "eur",
+        "recurring": {"interval": data['recurrence']} if data.get('recurrence') else None,
+        "tax_behavior": data.get("tax_behavior", "exclusive")
+    }
+    # Create Price for the product
+    new_price = _stripe_call_with_retry(
+        'price_create', stripe.Price.create,
+        unit_amount=price_data['unit_amount'],
+        currency=price_data['currency'],
+        product=product_id,
+        recurring=price_data.get('recurring'),
+        tax_behavior=price_data['tax_behavior'],
+        **({'idempotency_key': f"{idempotency_key}-price"} if idempotency_key else {})
+    )
+    LogSystem.log_info("price_created", product_id=product_id, amount=price_data['unit_amount'],
+                       currency=price_data['currency'])
+    return new_price
+
+
+def _invalid_product(data):
+    # Returns why a product for _create_stripe_product() is invalid, or None
+    if not isinstance(data, dict):
+        return 'Not a JSON object'
+    if not isinstance(data.get('name'), str) or not data['name']:
+        return 'Missing name'
+    if isinstance(data.get('price'), bool) or not isinstance(data.get('price'), (int, float)) or data['price'] <= 0:
+        return 'Invalid price'
+    if data.get('recurrence') not in (None, 'day', 'week', 'month', 'year'):
+        return 'Invalid recurrence'
+    return None
+
+
+# Stripe requests of bulk imports, shared by all requests so the number of parallel calls stays bounded
+bulk_import_pool = ThreadPoolExecutor(max_workers=bulk_import_workers, thread_name_prefix='ProductImport')
+
+
+# Background jobs
+NON_RETRYABLE_ERRORS = (stripe.InvalidRequestError, stripe.AuthenticationError, stripe.PermissionError)
+
+
+def _run_product_create_job(job):
+    """
+    Creates the product and then its price in Stripe and saves each object before the next
+    step. A retried or recovered job continues after the last saved step, and the
+    idempotency keys make Stripe return what an interrupted attempt created before it
+    could save it, so no product is created twice.
+    """
+    if 'product' not in job.progress:
+        new_product = _create_stripe_product_only(job.payload, f"job-{job.id}")
+        job.progress = {**job.progress, 'product': _to_dict(new_product)}
+        db.session.commit()
+    if 'price' not in job.progress:
+        new_price = _create_stripe_price(job.payload, job.progress['product']['id'], f"job-{job.id}")
+        job.progress = {**job.progress, 'price': _to_dict(new_price)}
+        db.session.commit()
+
+    # Add the product to the local catalog right away instead of waiting for the next sync
+    _upsert_product(job.progress['product'])
+    db.session.flush()
+    _upsert_price(job.progress['price'])
+    db.session.commit()
+    catalog_cache.invalidate()
+
+
+def _clean_up_product_create_job(job):
+    # A product whose price could not be created is archived, so it isn't offered without a price
+    if 'product' in job.progress and 'price' not in job.progress:
+        _stripe_call_with_retry('product_update', stripe.Product.modify, job.progress['product']['id'], active=False)
+        job.progress = {**job.progress, 'archived': True}
+
+
+JOB_TYPES = {
+    'product_create': (_run_product_create_job, _clean_up_product_create_job)  # (run, clean up after failing)
+}
+
+
+def enqueue_job(job_type, payload):
+    """Stores a job, which the job workers run after the commit. Returns the job."""
+    job = Job(id=str(uuid.uuid4()), type=job_type, payload=payload, progress={})
+    db.session.add(job)
+    return job
+
+
+def run_next_job():
+    """
+    Claims the next due job (queued, or running with an expired lease because its process
+    died) and runs it. Failed attempts are retried with exponential backoff, errors that
+    retrying can't fix fail the job right away. Returns False if no job was due.
+    """
+    now = datetime.utcnow()
+    due = (Job.status.in_(('queued', 'running')), Job.run_at <= now)
+    job_id = db.session.query(Job.id).filter(*due).order_by(Job.run_at).limit(1).scalar()
+    if job_id is None:
+        return False
+    claimed = db.session.execute(db.update(Job).where(Job.id == job_id, *due).values(
+        status='running', run_at=now + timedelta(seconds=job_lease), attempts=Job.attempts + 1)).rowcount
+    db.session.commit()
+    if not claimed:
+        return True  # Another worker was faster
+
+    job = db.session.get(Job, job_id)
+    run, clean_up = JOB_TYPES[job.type]
+    try:
+        run(job)
+        job.status = 'succeeded'
+        job.error = None
+        db.session.commit()
+        LogSystem.log_info("job_succeeded", job_id=job_id, type=job.type, attempts=job.attempts)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.error = str(e)
+        if isinstance(e, NON_RETRYABLE_ERRORS) or job.attempts >= job_max_attempts:
+            job.status = 'failed'
+            try:
+                clean_up(job)
+            except Exception as clean_up_error:
+                LogSystem.log_error("job_clean_up_failed", job_id=job_id, error=str(clean_up_error))
+            LogSystem.log_error("job_failed", job_id=job_id, type=job.type, attempts=job.attempts, error=str(e))
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=job_retry_backoff * 2 ** (job.attempts - 1))
+            LogSystem.log_warning("job_retry_scheduled", job_id=job_id, type=job.type, attempts=job.attempts,
+                                  error=str(e))
+        db.session.commit()
+    return True
+
+
+def _run_jobs():
+    with app.app_context():
+        return run_next_job()
+
+
+job_pool = WorkerPool(
+    _run_jobs,
+    workers=job_workers,
+    poll_interval=job_poll_interval,
+    on_error=lambda e: LogSystem.log_error("job_worker_failed", error=str(e)),
+    name="JobWorker"
+)
+
+
+@app.before_request
+def start_background_workers():
+    # Jobs and webhook events left over from a previous run are picked up once the server handles requests
+    job_pool.start()
+    webhook_retry_pool.start()
+
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Runs all due background jobs in the foreground."""
+    while run_next_job():
+        pass
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    # Status and progress of a background job
+    try:
+        job = db.session.get(Job, job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        response = {
+            'id': job.id,
+            'type': job.type,
+            'status': job.status,
+            'progress': {step: obj['id'] for step, obj in job.progress.items() if isinstance(obj, dict)},
+            'attempts': job.attempts,
+            'error': job.error,
+            'created_at': job.created_at.isoformat(),
+            'updated_at': job.updated_at.isoformat()
+        }
+        if job.status == 'queued' and job.attempts:
+            response['next_attempt_at'] = job.run_at.isoformat()
+        if job.status == 'succeeded' and job.type == 'product_create':
+            response['result'] = job.progress['product']
+        return jsonify(response), 200
+    except Exception as e:
+        LogSystem.log_error("job_status_failed", route='GET /jobs/<job_id>', error=str(e), job_id=job_id)
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/product', methods=['GET', 'POST'])
 def product():
     if request.method == 'GET':
-        # Fetch products from Stripe
+        # Serve products from the local catalog, which is synced with Stripe in the background.
+        # Until the first sync has finished, products come from the cache of the Stripe product list.
         try:
-            products = stripe.Product.list()
-            return jsonify({'products': products.data}), 200
+            if _catalog_mirror_ready():
+                return jsonify(_list_local_products(request.args)), 200
+            return jsonify(_list_cached_products(catalog_cache.get(), request.args)), 200
+        except ValueError:
+            return jsonify({'error': 'Invalid limit'}), 400
         except Exception as e:
-            LogSystem.log_error(
-                f"Error fetching products in GET /product: {str(e)}. Associated user: {request.args.get('user_id', 'Unknown')}")
+            LogSystem.log_error("product_list_failed", route='GET /product', error=str(e),
+                                user_id=request.args.get('user_id'))
             return jsonify({'error': str(e)}), 500
 
     elif request.method == 'POST':
-        # Create a new product in Stripe
+        # Create a new product in Stripe in the background, see GET /jobs/<job_id> for the result
         try:
             data = request.json
-
-            # Convert price and set required fields
-            price_data = {
-                "unit_amount": int(data['price'] * 100),
-                "currency": "eur",
-                "recurring": {"interval": data['recurrence']} if data.get('recurrence') else None,
-                "tax_behavior": data.get("tax_behavior", "exclusive")
-            }
-
-            # Create product in Stripe
-            new_product = stripe.Product.create(
-                name=data['name'],
-                description=data.get('description', ''),
-                metadata=data.get('metadata', {})
-            )
-            # Create Price for the product
-            LogSystem.log_info(f"Product '{new_product['name']}' successfully created with ID: {new_product['id']}")
-            stripe.Price.create(
-                unit_amount=price_data['unit_amount'],
-                currency=price_data['currency'],
-                product=new_product['id'],
-                recurring=price_data.get('recurring'),
-                tax_behavior=price_data['tax_behavior']
-            )
-            LogSystem.log_info(
-                f"Price created for product '{new_product['name']}': Amount={price_data['unit_amount']}, Currency='{price_data['currency']}'")
-            return jsonify(new_product), 201
+            error = _invalid_product(data)
+            if error:
+                return jsonify({'error': error}), 400
+            job_id = enqueue_job('product_create', data).id
+            db.session.commit()
+            job_pool.wake()
+            LogSystem.log_info("product_create_queued", job_id=job_id, name=data['name'])
+            status_url = url_for('job_status', job_id=job_id)
+            return jsonify({'job_id': job_id, 'status': 'queued', 'status_url': status_url}), 202, \
+                {'Location': status_url}
         except Exception as e:
-            LogSystem.log_error(f"Error creating a product in POST /product: {str(e)}. Request data: {request.json}")
+            LogSystem.log_error("product_create_failed", route='POST /product', error=str(e),
+                                request_data=request.get_json(silent=True))
             return jsonify({'error': str(e)}), 500
 
 
+def _bulk_products():
+    # The products of the request: NDJSON (one product per line, read while it is uploaded),
+    # a JSON list or {"products": [...]}. Lines that aren't valid JSON are yielded as None.
+    if request.mimetype == 'application/x-ndjson':
+        for line in request.stream:
+            if line.strip():
+                try:
+                    yield app.json.loads(line)
+                except ValueError:
+                    yield None
+    else:
+        data = request.json
+        yield from data['products'] if isinstance(data, dict) else data
+
+
+@app.route('/product/bulk', methods=['POST'])
+def product_bulk():
+    """
+    Creates many products in Stripe concurrently on the bulk import pool and adds them to the
+    local catalog in one transaction. Every product gets an idempotency key (its
+    "idempotency_key" or a hash of its content), so a retried import returns the products
+    created before instead of duplicates. Returns a result per product.
+    """
+    try:
+        if not _is_admin():
+            return jsonify({'error': 'Forbidden'}), 403
+        results = []
+        pending = []
+        for index, data in enumerate(_bulk_products()):
+            result = {'index': index, 'name': data.get('name') if isinstance(data, dict) else None}
+            results.append(result)
+            error = _invalid_product(data)
+            if index >= bulk_import_max_items:
+                result['error'] = f'More than {bulk_import_max_items} products'
+            elif error:
+                result['error'] = error
+            else:
+                key = data.get('idempotency_key') or 'product-import-' + hashlib.sha256(
+                    json.dumps(data, sort_keys=True).encode()).hexdigest()
+                pending.append((result, bulk_import_pool.submit(_create_stripe_product, data, key)))
+        if not results:
+            return jsonify({'error': 'No products'}), 400
+
+        created = []
+        for result, future in pending:
+            try:
+                new_product, new_price = future.result()
+            except stripe.StripeError as e:
+                result['error'] = e.user_message or str(e)
+                continue
+            result.update(product_id=new_product['id'], price_id=new_price['id'])
+            created.append((new_product, new_price))
+
+        # Add the products to the local catalog right away instead of waiting for the next sync
+        for new_product, _ in created:
+            _upsert_product(new_product)
+        db.session.flush()
+        for _, new_price in created:
+            _upsert_price(new_price)
+        db.session.commit()
+        catalog_cache.invalidate()
+
+        failed = len(results) - len(created)
+        LogSystem.log_info("product_bulk_imported", created=len(created), failed=failed)
+        return jsonify({'created': len(created), 'failed': failed, 'results': results}), 200
+    except Exception as e:
+        LogSystem.log_error("product_bulk_failed", route='POST /product/bulk', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/product/cache', methods=['GET'])
+def product_cache():
+    # Hit, miss and refresh latency counters of the product cache
+    return jsonify(catalog_cache.stats()), 200
+
+
+def _coin_product(product_id):
+    """
+    Returns (name, coin price) of an active product with a "coin_price" in its metadata,
+    taken from the local catalog or, until it is filled, from the cached Stripe list.
+    """
+    if _catalog_mirror_ready():
+        product = Product.query.get(product_id)
+        product = product and {'name': product.name, 'active': product.active, 'metadata': product.metadata_}
+    else:
+        product = next((p for p in catalog_cache.get() if p['id'] == product_id), None)
+    if not product or not product['active']:
+        return None
+    try:
+        coin_price = int((product['metadata'] or {})['coin_price'])
+    except (KeyError, ValueError):
+        return None
+    return (product['name'], coin_price) if coin_price > 0 else None
+
+
+@app.route('/purchase', methods=['POST'])
+def purchase():
+    # Buy a product with coins: deduct the price and record the purchase in one transaction
+    try:
+        data = request.json
+        product_id = data['product_id']
+
+        user_id = _authenticate(data.get('user_id'), data.get('secret'))
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        replay = _idempotency_replay(user_id)
+        if replay:
+            return replay
+        product = _coin_product(product_id)
+        if not product:
+            return jsonify({'error': 'Product not found or not for sale with coins'}), 404
+        product_name, coin_price = product
+
+        coins = _change_coins(user_id, 'deduct', coin_price, reason='purchase')
+        if coins is None:
+            return jsonify({'error': 'Not enough coins'}), 400
+        purchase_date = datetime.utcnow()
+        db.session.add(PurchaseHistory(user_id=user_id, product_name=product_name, purchase_date=purchase_date))
+        response = _idempotent_response((jsonify({
+            'message': 'Purchase successful',
+            'coins': coins,
+            'purchase': {'product_name': product_name, 'purchase_date': purchase_date.isoformat()}
+        }), 201))
+        db.session.commit()
+        coin_snapshot_task.trigger()
+
+        LogSystem.log_info("purchase_completed", user_id=user_id, product_id=product_id, product_name=product_name,
+                           price=coin_price, coins=coins)
+        return response
+    except Exception as e:
+        LogSystem.log_error("purchase_failed", route='POST /purchase', error=str(e),
+                            user_id=_body_field('user_id'), product_id=_body_field('product_id'))
+        return jsonify({'error': str(e)}), 500
+
+
+# Stripe webhooks
+PAID_CHECKOUT_EVENTS = ('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+
+
+def _apply_stripe_event(payload):
+    """
+    Writes the purchase of a paid checkout session: a PurchaseHistory row and, with
+    "coins" in the session metadata, the coin credit. The user is the client_reference_id
+    of the session (or "user_id" in its metadata), the product name comes from the
+    "product_name" metadata. Other events are ignored. The caller commits.
+    """
+    if payload['type'] not in PAID_CHECKOUT_EVENTS:
+        return
+    session = payload['data']['object']
+    if session.get('payment_status') != 'paid':
+        return  # checkout.session.async_payment_succeeded follows once the payment arrived
+    metadata = session.get('metadata') or {}
+    user_id = session.get('client_reference_id') or metadata.get('user_id')
+    if not user_id or not _load_auth([user_id]):
+        raise ValueError(f"Unknown user {user_id!r}")
+    coins = int(metadata.get('coins', 0))
+
+    db.session.add(PurchaseHistory(user_id=user_id, product_name=metadata.get('product_name', 'Stripe payment'),
+                                   purchase_date=datetime.utcfromtimestamp(payload['created'])))
+    if coins > 0:
+        _change_coins(user_id, 'add', coins, reason='stripe_purchase')
+    else:
+        db.session.execute(db.update(User).where(User.id == user_id).values(version=User.version + 1))
+
+
+# Errors an event fails with on every attempt: unknown user or malformed payload
+PERMANENT_WEBHOOK_ERRORS = (ValueError, KeyError, TypeError)
+
+
+def _record_failed_event(event_id, error):
+    # Permanent errors and the last attempt mark the event as processed, otherwise it's retried with backoff
+    event = db.session.get(StripeEvent, event_id)
+    attempts = event.attempts + 1
+    now = datetime.utcnow()
+    if isinstance(error, PERMANENT_WEBHOOK_ERRORS) or attempts >= webhook_max_attempts:
+        values = {'processed_at': now}
+        LogSystem.log_error("webhook_event_failed", event_id=event_id, attempts=attempts, error=str(error))
+    else:
+        values = {'next_attempt_at': now + timedelta(seconds=webhook_retry_backoff * 2 ** (attempts - 1))}
+        LogSystem.log_warning("webhook_event_retry_scheduled", event_id=event_id, attempts=attempts,
+                              error=str(error))
+    db.session.execute(db.update(StripeEvent).where(StripeEvent.id == event_id).values(
+        attempts=attempts, error=str(error), **values))
+    db.session.commit()
+
+
+def _claim_and_apply(event):
+    # The conditional UPDATE makes sure only one worker or process applies an event
+    claimed = db.session.execute(db.update(StripeEvent).where(
+        StripeEvent.id == event.id, StripeEvent.processed_at.is_(None)).values(
+        processed_at=datetime.utcnow())).rowcount
+    if claimed:
+        _apply_stripe_event(event.payload)
+    return claimed
+
+
+def process_stripe_events(event_ids):
+    """
+    Applies the given unprocessed webhook events in one transaction. If that fails, the
+    events are applied one by one. An event that fails permanently (see
+    PERMANENT_WEBHOOK_ERRORS) is marked as processed with its error, after a transient
+    error (e.g. a locked database) it is retried later. Returns the number of events applied.
+    """
+    events = StripeEvent.query.filter(StripeEvent.id.in_(event_ids), StripeEvent.processed_at.is_(None)).order_by(
+        StripeEvent.received_at).all()
+    try:
+        applied = sum(_claim_and_apply(event) for event in events)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        LogSystem.log_warning("webhook_batch_retried_singly", events=len(events), error=str(e))
+        applied = 0
+        for event_id in [event.id for event in events]:
+            event = db.session.get(StripeEvent, event_id)
+            try:
+                applied += _claim_and_apply(event)
+                db.session.commit()
+            except Exception as event_error:
+                db.session.rollback()
+                try:
+                    _record_failed_event(event_id, event_error)
+                except Exception as record_error:  # The event stays pending and is retried
+                    db.session.rollback()
+                    LogSystem.log_error("webhook_event_failed", event_id=event_id, error=str(event_error),
+                                        record_error=str(record_error))
+    if applied:
+        coin_snapshot_task.trigger()
+    LogSystem.log_info("webhook_events_applied", applied=applied)
+    return applied
+
+
+def _process_webhook_batch(event_ids):
+    with app.app_context():
+        process_stripe_events(event_ids)
+
+
+webhook_worker = QueueWorker(
+    _process_webhook_batch,
+    batch_size=webhook_batch_size,
+    flush_interval=webhook_flush_interval,
+    on_error=lambda e, batch: LogSystem.log_error("webhook_batch_failed", events=len(batch), error=str(e)),
+    name="WebhookWorker"
+)
+
+
+def process_pending_stripe_events(older_than=0):
+    """
+    Applies the events that were received more than `older_than` seconds ago but not
+    applied, e.g. because the process stopped before its worker got to them, and the
+    events whose retry after a transient error is due.
+    """
+    now = datetime.utcnow()
+    received_before = now - timedelta(seconds=older_than)
+    applied = 0
+    query = db.session.query(StripeEvent.received_at, StripeEvent.id).filter(
+        StripeEvent.processed_at.is_(None),
+        db.or_(db.and_(StripeEvent.next_attempt_at.is_(None), StripeEvent.received_at < received_before),
+               StripeEvent.next_attempt_at <= now)).order_by(StripeEvent.received_at, StripeEvent.id)
+    last = None
+    while True:
+        # Keyset pagination, events that fail again stay pending and must not be fetched twice
+        page = query.filter(db.tuple_(StripeEvent.received_at, StripeEvent.id) > last) if last else query
+        rows = page.limit(webhook_batch_size).all()
+        if not rows:
+            return applied
+        last = tuple(rows[-1])
+        applied += process_stripe_events([row.id for row in rows])
+
+
+def _retry_webhooks():
+    with app.app_context():
+        process_pending_stripe_events(older_than=webhook_retry_interval)
+    return False  # Wait webhook_retry_interval for the next check
+
+
+webhook_retry_pool = WorkerPool(
+    _retry_webhooks,
+    workers=1,
+    poll_interval=webhook_retry_interval,
+    on_error=lambda e: LogSystem.log_error("webhook_retry_failed", error=str(e)),
+    name="WebhookRetry"
+)
+
+
+@app.route('/webhook/stripe', methods=['POST'])
+def stripe_webhook():
+    """
+    Receives Stripe events: verifies the signature, stores the event once (redeliveries
+    are acknowledged without storing them again) and leaves applying it to the webhook
+    worker, so Stripe gets its answer after a single INSERT. Answers 503 until a signing
+    secret (whsec_...) is set in key.py, nothing is accepted without a signature check.
+    """
+    try:
+        secret = _configured_secret(key.stripe_webhook_secret, prefix='whsec_')
+        if not secret:
+            return jsonify({'error': 'Stripe webhook is not configured'}), 503
+        payload = request.get_data(as_text=True)
+        try:
+            stripe.WebhookSignature.verify_header(payload, request.headers.get('Stripe-Signature'), secret,
+                                                  stripe.Webhook.DEFAULT_TOLERANCE)
+            event = app.json.loads(payload)
+        except (stripe.SignatureVerificationError, ValueError):
+            webhook_events_total.inc(result='invalid')
+            return jsonify({'error': 'Invalid signature or payload'}), 400
+
+        db.session.add(StripeEvent(id=event['id'], type=event['type'], payload=event))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            webhook_events_total.inc(result='duplicate')
+            return jsonify({'received': True, 'duplicate': True}), 200
+
+        webhook_worker.put(event['id'])
+        webhook_events_total.inc(result='accepted')
+        return jsonify({'received': True}), 200
+    except Exception as e:
+        LogSystem.log_error("webhook_failed", route='POST /webhook/stripe', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+
+@app.cli.command('process-webhooks')
+def process_webhooks_command():
+    """Applies all received but unapplied Stripe webhook events."""
+    applied = process_pending_stripe_events()
+    LogSystem.log_info("webhook_events_processed", applied=applied)
+
+
+def _new_user_id():
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, uuid_salt + str(uuid.uuid4())))
+
+
+def create_accounts(accounts):
+    """
+    Creates many accounts from dicts with "username" and "password" (or, for migrations, an
+    existing werkzeug "password_hash"). Taken usernames are found with one query, the
+    passwords are hashed on all hashing processes and the users are inserted with one
+    executemany per account_bulk_chunk_size accounts. Returns a result per account with
+    "user_id" and "secret" or an "error".
+    """
+    results = [{'index': index, 'username': account.get('username') if isinstance(account, dict) else None}
+               for index, account in enumerate(accounts)]
+    seen = set()
+    valid = []
+    for result, account in zip(results, accounts):
+        username = result['username']
+        if not isinstance(username, str) or not 0 < len(username) <= 50:
+            result['error'] = 'Invalid username'
+        elif not isinstance(account.get('password', account.get('password_hash')), str) \
+                or not account.get('password', account.get('password_hash')):
+            result['error'] = 'Missing password'
+        elif username in seen:
+            result['error'] = 'Duplicate username'
+        else:
+            seen.add(username)
+            valid.append((result, account))
+
+    taken = set()
+    usernames = [result['username'] for result, _ in valid]
+    for start in range(0, len(usernames), account_bulk_chunk_size):
+        taken.update(row.username for row in db.session.query(User.username).filter(
+            User.username.in_(usernames[start:start + account_bulk_chunk_size])))
+    for result, _ in valid:
+        if result['username'] in taken:
+            result['error'] = 'Username already exists'
+    valid = [(result, account) for result, account in valid if 'error' not in result]
+
+    to_hash = [account['password'] for _, account in valid if 'password' in account]
+    hashes = iter(password_hasher.hash_many(to_hash) if to_hash else [])
+    rows = []
+    for result, account in valid:
+        rows.append({
+            'id': _new_user_id(),
+            'username': result['username'],
+            'password': next(hashes) if 'password' in account else account['password_hash'],
+            'secret': _new_user_id(),
+            'data': {},
+            'coins': 0,
+            'version': 0
+        })
+        result['row'] = rows[-1]
+
+    for start in range(0, len(rows), account_bulk_chunk_size):
+        chunk = rows[start:start + account_bulk_chunk_size]
+        try:
+            db.session.execute(db.insert(User), chunk)
+            db.session.commit()
+        except IntegrityError:
+            # A username was taken in the meantime, insert this chunk one by one
+            db.session.rollback()
+            for row in chunk:
+                try:
+                    db.session.execute(db.insert(User), [row])
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    row['id'] = None
+
+    for result in results:
+        row = result.pop('row', None)
+        if row and row['id']:
+            result.update(user_id=row['id'], secret=row['secret'])
+        elif row:
+            result['error'] = 'Username already exists'
+    return results
+
+
+@app.route('/account/bulk', methods=['POST'])
+def account_bulk():
+    """
+    Admin endpoint: creates up to account_bulk_max_size accounts, e.g. test or migrated
+    players. Body: a list (or {"accounts": [...]}) of {"username", "password"}. Returns
+    the user_id and secret, or the error, per account.
+    """
+    try:
+        if not _is_admin():
+            return jsonify({'error': 'Forbidden'}), 403
+        data = request.json
+        accounts = data.get('accounts') if isinstance(data, dict) else data
+        if not isinstance(accounts, list) or not accounts or len(accounts) > account_bulk_max_size:
+            return jsonify({'error': f'Accounts must be a list of 1 to {account_bulk_max_size} items'}), 400
+        # Existing hashes are only accepted from the CLI
+        accounts = [{k: v for k, v in account.items() if k != 'password_hash'} if isinstance(account, dict)
+                    else account for account in accounts]
+
+        results = create_accounts(accounts)
+        created = sum('user_id' in result for result in results)
+        LogSystem.log_info("accounts_bulk_created", created=created, failed=len(results) - created)
+        return jsonify({'created': created, 'failed': len(results) - created, 'results': results}), 200
+    except PasswordHasherBusy:
+        return _hasher_busy()
+    except Exception as e:
+        LogSystem.log_error("account_bulk_failed", route='POST /account/bulk', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+
+@app.cli.command('create-accounts')
+@click.argument('source', type=click.File('r'))
+@click.argument('target', type=click.File('w'), default='-')
+def create_accounts_command(source, target):
+    """
+    Creates the accounts in SOURCE, one JSON object per line with "username" and "password"
+    or an existing werkzeug "password_hash", and writes a result per line to TARGET.
+    """
+    created = failed = 0
+    batch = []
+    for line in itertools.chain(source, [None]):
+        if line is not None and line.strip():
+            batch.append(json.loads(line))
+        if batch and (line is None or len(batch) >= account_bulk_max_size):
+            for result in create_accounts(batch):
+                result['index'] += created + failed
+                created += 'user_id' in result
+                failed += 'user_id' not in result
+                target.write(json.dumps(result) + '\n')
+            batch = []
+    LogSystem.log_info("accounts_bulk_created", created=created, failed=failed)
+    click.echo(f"Created {created} accounts, {failed} failed", err=True)
+
+
 @app.route('/account', methods=['POST', 'GET', 'PUT'])
 def account():
     if request.method == 'POST':
@@ -108,24 +1926,36 @@ def account():
             username = data['username']
             password = data['password']
 
+            # A retried request gets the first response, without hashing the password again
+            replay = _idempotency_replay()
+            if replay:
+                return replay
+            limited = _rate_limited()
+            if limited:
+                return limited
+
             # Check if the username already exists
             if User.query.filter_by(username=username).first():
                 return jsonify({'error': 'Username already exists'}), 400
 
             # Hash the password and create the user
-            hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
-            secret = str(uuid.uuid5(uuid.NAMESPACE_DNS, uuid_salt + str(uuid.uuid4())))
+            hashed_password = _hash_password(password)
+            secret = _new_user_id()
 
-            user_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, uuid_salt + str(uuid.uuid4())))  # Generate a unique user ID
+            user_id = _new_user_id()  # Generate a unique user ID
             new_user = User(id=user_id, username=username, password=hashed_password, secret=secret)
-            LogSystem.log_info(f"Created user: {username} with hashed password: {hashed_password}")
             db.session.add(new_user)
-            LogSystem.log_info(f"New user '{username}' successfully added to the database with ID: {user_id}")
+            response = _idempotent_response((jsonify(
+                {'message': 'Account created successfully', 'user_id': user_id, 'secret': secret}), 201))
             db.session.commit()
+            LogSystem.log_info("account_created", user_id=user_id, username=username)
 
-            return jsonify({'message': 'Account created successfully', 'user_id': user_id, 'secret': secret}), 201
+            return response
+        except PasswordHasherBusy:
+            return _hasher_busy()
         except Exception as e:
-            LogSystem.log_error(f"Error creating account: {str(e)}. Request data: {request.json}")
+            LogSystem.log_error("account_create_failed", route='POST /account', error=str(e),
+                                username=_body_field('username'))
             return jsonify({'error': str(e)}), 500
 
     elif request.method == 'GET':
@@ -135,80 +1965,208 @@ def account():
             secret = request.args.get('secret')
             password = request.args.get('password')
 
-            if not user_id or (not secret and not password):
+            use_token = 'Authorization' in request.headers
+            if use_token:
+                user_id = _authenticate(user_id, None)
+                if not user_id:
+                    return jsonify({'error': 'Access denied: Invalid token'}), 401
+            elif not user_id or (not secret and not password):
                 return jsonify({'error': 'Access denied: Missing required credentials'}), 401
 
-            # Fetch the user by ID
-            user = User.query.get(user_id)
-
-            if not user:
+            # The token or the secret (checked against the cache) are enough, the password needs the stored hash
+            auth = _load_auth([user_id]).get(user_id)
+            if not auth:
                 return jsonify({'error': 'User not found'}), 404
+            authorized = use_token or (secret and auth[0] == secret)
+            if not authorized and password:
+                limited = _rate_limited(auth[1])
+                if limited:
+                    return limited
+                stored_password = db.session.query(User.password).filter_by(id=user_id).scalar()
+                authorized = _check_password(stored_password, password)
 
-            # If the secret is provided, verify it
-            if secret and user.secret == secret:
-                return jsonify({
-                    'username': user.username,
-                    'coins': user.coins,
-                    'purchases': [
-                        {
-                            'product_name': ph.product_name,
-                            'purchase_date': ph.purchase_date.isoformat()
-                        } for ph in PurchaseHistory.query.filter_by(user_id=user_id).all()
-                    ]
-                }), 200
-
-            # If the password is provided, verify it
-            if password and check_password_hash(user.password, password):
-                return jsonify({
-                    'username': user.username,
-                    'coins': user.coins,
-                    'purchases': [
-                        {
-                            'product_name': ph.product_name,
-                            'purchase_date': ph.purchase_date.isoformat()
-                        } for ph in PurchaseHistory.query.filter_by(user_id=user_id).all()
-                    ]
-                }), 200
+            if authorized:
+                # Version, coins and username in one query, so the ETag always matches the coins in the response
+                user = db.session.query(User.version, User.coins, User.username).filter_by(id=user_id).first()
+                if user is None:
+                    return jsonify({'error': 'User not found'}), 404
+
+                def build():
+                    purchases, _ = _list_purchases(user_id, account_recent_purchases)
+                    return jsonify({
+                        'username': user.username,
+                        'coins': user.coins,
+                        'purchase_count': db.session.query(db.func.count(PurchaseHistory.id)).filter(
+                            PurchaseHistory.user_id == user_id).scalar(),
+                        'purchases': purchases  # Only the most recent ones, see GET /account/purchases
+                    }), 200
+
+                return _conditional_response(user_id, user.version, build)
 
             # If neither secret nor password matches, deny access
             return jsonify({'error': 'Access denied: Invalid credentials'}), 401
 
+        except PasswordHasherBusy:
+            return _hasher_busy()
         except Exception as e:
-            LogSystem.log_error(f"Error fetching account info: {str(e)}")
+            LogSystem.log_error("account_fetch_failed", route='GET /account', error=str(e),
+                                user_id=request.args.get('user_id'))
             return jsonify({'error': str(e)}), 500
 
     elif request.method == 'PUT':
         # Update coins (add or deduct), requires secret
         try:
             data = request.json
-            user_id = data['user_id']
-            secret = data.get('secret')
             action = data['action']  # "add" or "deduct"
             amount = data['amount']
 
-            user = User.query.get(user_id)
-            if not user or user.secret != secret:
+            user_id = _authenticate(data.get('user_id'), data.get('secret'))
+            if not user_id:
                 return jsonify({'error': 'Unauthorized'}), 401
-
-            # Perform the action (add or deduct coins)
-            if action == 'add':
-                user.coins += amount
-            elif action == 'deduct':
-                if user.coins < amount:
-                    return jsonify({'error': 'Not enough coins'}), 400
-                user.coins -= amount
-            else:
+            replay = _idempotency_replay(user_id)
+            if replay:
+                return replay
+            if action not in ('add', 'deduct'):
                 return jsonify({'error': 'Invalid action'}), 400
+            if not _valid_amount(amount):
+                return jsonify({'error': 'Invalid amount'}), 400
+
+            # Perform the action (add or deduct coins) in a single UPDATE
+            coins = _change_coins(user_id, action, amount)
+            if coins is None:
+                return jsonify({'error': 'Not enough coins'}), 400
 
+            response = _idempotent_response((jsonify({'message': 'Coins updated successfully', 'coins': coins}), 200))
             db.session.commit()
-            LogSystem.log_info(
-                f"User '{user.id}' coins updated: Action='{action}', Amount={amount}. Total={user.coins}")
-            return jsonify({'message': 'Coins updated successfully', 'coins': user.coins}), 200
+            coin_snapshot_task.trigger()
+            LogSystem.log_info("coins_updated", user_id=user_id, action=action, amount=amount, coins=coins)
+            return response
         except Exception as e:
-            LogSystem.log_error(f"Error updating coins: {str(e)}.")
+            LogSystem.log_error("coins_update_failed", route='PUT /account', error=str(e))
             return jsonify({'error': str(e)}), 500
 
 
+@app.route('/account/purchases', methods=['GET'])
+def account_purchases():
+    # Purchase history of a user, newest first, with keyset pagination
+    try:
+        user_id = _authenticate(request.args.get('user_id'), request.args.get('secret'))
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+        purchases, next_cursor = _list_purchases(user_id, limit, request.args.get('cursor'))
+        return jsonify({'purchases': purchases, 'next_cursor': next_cursor}), 200
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    except Exception as e:
+        LogSystem.log_error("purchases_fetch_failed", route='GET /account/purchases', error=str(e),
+                            user_id=request.args.get('user_id'))
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/account/coins/batch', methods=['POST'])
+def coin_batch():
+    """
+    Applies many coin operations in one transaction. In mode "atomic" (default) nothing is
+    applied if any operation fails, in mode "best_effort" the failed operations are skipped.
+    """
+    try:
+        data = request.json
+        mode = data.get('mode', 'atomic')
+        operations = data['operations']
+        if mode not in ('atomic', 'best_effort'):
+            return jsonify({'error': 'Invalid mode'}), 400
+        if not isinstance(operations, list) or not operations or len(operations) > coin_batch_max_size:
+            return jsonify({'error': f'Operations must be a list of 1 to {coin_batch_max_size} items'}), 400
+
+        # Load all secrets from the cache or with one query
+        user_ids = {op.get('user_id') for op in operations if isinstance(op, dict)}
+        secrets = {user_id: entry[0] for user_id, entry in _load_auth(user_ids).items()}
+
+        results = []
+        failed = 0
+        with db.session.no_autoflush:  # Insert the ledger entries together at commit
+            for index, op in enumerate(operations):
+                result = {'index': index, 'user_id': op.get('user_id') if isinstance(op, dict) else None}
+                results.append(result)
+                if not isinstance(op, dict) or secrets.get(op.get('user_id')) is None \
+                        or secrets[op['user_id']] != op.get('secret'):
+                    result['error'] = 'Unauthorized'
+                elif op.get('action') not in ('add', 'deduct'):
+                    result['error'] = 'Invalid action'
+                elif not _valid_amount(op.get('amount')):
+                    result['error'] = 'Invalid amount'
+                else:
+                    coins = _change_coins(op['user_id'], op['action'], op['amount'])
+                    if coins is None:
+                        result['error'] = 'Not enough coins'
+                    else:
+                        result['coins'] = coins
+                if 'error' in result:
+                    failed += 1
+                    if mode == 'atomic':
+                        break
+
+        if failed and mode == 'atomic':
+            db.session.rollback()
+            for result in results:
+                if 'coins' in result:
+                    del result['coins']
+                    result['error'] = 'Rolled back'
+            for index in range(len(results), len(operations)):
+                op = operations[index]
+                results.append({'index': index, 'user_id': op.get('user_id') if isinstance(op, dict) else None,
+                                'error': 'Not applied'})
+            return jsonify({'message': 'No coins updated', 'applied': 0, 'failed': failed, 'results': results}), 400
+
+        db.session.commit()
+        coin_snapshot_task.trigger()
+        LogSystem.log_info("coin_batch_applied", mode=mode, applied=len(results) - failed, failed=failed)
+        return jsonify({'message': 'Coins updated successfully', 'applied': len(results) - failed,
+                        'failed': failed, 'results': results}), 200
+    except Exception as e:
+        LogSystem.log_error("coin_batch_failed", route='POST /account/coins/batch', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/account/coins/history', methods=['GET'])
+def coin_history():
+    # Ledger entries of a user, newest first, with keyset pagination
+    try:
+        user_id = _authenticate(request.args.get('user_id'), request.args.get('secret'))
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+
+        query = db.session.query(
+            CoinTransaction.id, CoinTransaction.amount, CoinTransaction.balance,
+            CoinTransaction.reason, CoinTransaction.created_at
+        ).filter(CoinTransaction.user_id == user_id)
+        if request.args.get('cursor'):
+            created_at, transaction_id = _decode_cursor(request.args['cursor'])
+            query = query.filter(db.tuple_(CoinTransaction.created_at, CoinTransaction.id) < (created_at, transaction_id))
+        rows = query.order_by(CoinTransaction.created_at.desc(), CoinTransaction.id.desc()).limit(limit + 1).all()
+
+        next_cursor = _encode_cursor(rows[limit - 1].created_at, rows[limit - 1].id) if len(rows) > limit else None
+        return jsonify({
+            'transactions': [
+                {
+                    'amount': row.amount,
+                    'balance': row.balance,
+                    'reason': row.reason,
+                    'created_at': row.created_at.isoformat()
+                } for row in rows[:limit]
+            ],
+            'next_cursor': next_cursor
+        }), 200
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    except Exception as e:
+        LogSystem.log_error("coin_history_failed", route='GET /account/coins/history', error=str(e),
+                            user_id=request.args.get('user_id'))
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/login', methods=['POST'])
 def login():
     # Authenticate user
@@ -217,69 +2175,235 @@ def login():
         username = data['username']
         password = data['password']
 
+        limited = _rate_limited(username)
+        if limited:
+            return limited
+
         user = User.query.filter_by(username=username).first()
         if not user:
             return jsonify({'error': 'User not found'}), 404
-        if not check_password_hash(user.password, password):
-            app.logger.info(f"Login attempt failed. Invalid password for user: {username}")
+        if not _check_password(user.password, password):
+            LogSystem.log_warning("login_failed", username=username, reason='invalid_password')
             return jsonify({'error': 'Invalid username or password'}), 401
 
-        return jsonify(
-            {'message': 'Login successful', 'username': username, 'user_id': user.id, 'secret': user.secret}), 200
+        # Hashes made with an older method or cost are replaced while the password is at hand
+        if password_hasher.needs_rehash(user.password):
+            user.password = _hash_password(password)
+            db.session.commit()
+            LogSystem.log_info("password_rehashed", user_id=user.id, method=password_hasher.method)
+
+        return jsonify({'message': 'Login successful', 'username': username, 'user_id': user.id, 'secret': user.secret,
+                        **_issue_tokens(user.id)}), 200
+    except PasswordHasherBusy:
+        return _hasher_busy()
+    except Exception as e:
+        LogSystem.log_error("login_error", route='POST /login', error=str(e),
+                            username=_body_field('username'))
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/token/refresh', methods=['POST'])
+def refresh_token():
+    # Exchange a refresh token for a new access and refresh token
+    try:
+        if not token_signer.enabled:
+            return jsonify({'error': 'Tokens are not enabled on this server'}), 404
+        payload = _verify_token(_body_field('refresh_token') or '', 'refresh')
+        if not payload or not _load_auth([payload['sub']]):
+            return jsonify({'error': 'Invalid refresh token'}), 401
+        return jsonify({'user_id': payload['sub'], **_issue_tokens(payload['sub'])}), 200
     except Exception as e:
-        LogSystem.log_error(f"Error during login: {str(e)}. Request data: {request.json}")
+        LogSystem.log_error("token_refresh_failed", route='POST /token/refresh', error=str(e))
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/logout', methods=['POST'])
+def logout():
+    # Invalidate all tokens and the secret of the user, on every device
+    try:
+        data = request.get_json(silent=True) or {}
+        user_id = _authenticate(data.get('user_id'), data.get('secret'))
+        if not user_id:
+            return jsonify({'error': 'Unauthorized'}), 401
+        revoke_tokens(user_id)
+        LogSystem.log_info("tokens_revoked", user_id=user_id)
+        return jsonify({'message': 'Logged out'}), 200
+    except Exception as e:
+        LogSystem.log_error("logout_failed", route='POST /logout', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+
+@app.cli.command('revoke-tokens')
+@click.argument('user_id')
+def revoke_tokens_command(user_id):
+    """Forces a logout of the user by revoking all tokens and replacing the secret."""
+    revoke_tokens(user_id)
+    LogSystem.log_info("tokens_revoked", user_id=user_id)
+
+
 @app.route('/data', methods=['GET', 'PUT'])
 def data():
     ALLOWED_KEYS = {"level", "preferences", "score"}  # Erlaubte Schlüssel im Datenfeld
+    NUMERIC_KEYS = {"level", "score"}  # Schlüssel mit Zahlenwerten, nur diese können erhöht werden
 
     if request.method == 'GET':
         try:
             user_id = request.args.get('user_id')
-            user = User.query.get(user_id)
-            if not user:
+            version = db.session.query(User.version).filter_by(id=user_id).scalar()
+            if version is None:
                 return jsonify({'error': 'User not found'}), 404
-            return jsonify({'data': user.data}), 200
+            return _conditional_response(user_id, version, lambda: (jsonify(
+                {'data': db.session.query(User.data).filter_by(id=user_id).scalar()}), 200))
         except Exception as e:
-            LogSystem.log_error(
-                f"Error fetching user data: {str(e)}. User ID: {request.args.get('user_id', 'Unknown')}")
+            LogSystem.log_error("user_data_fetch_failed", route='GET /data', error=str(e),
+                                user_id=request.args.get('user_id'))
             return jsonify({'error': str(e)}), 500
 
     elif request.method == 'PUT':
         try:
             data = request.json
-            user_id = data['user_id']
-            secret = data.get('secret')
-            if not user_id or not secret:
+            if 'Authorization' not in request.headers and (not data.get('user_id') or not data.get('secret')):
                 return jsonify({'error': 'Missing user_id or secret'}), 400
-            user_data = data['data']
+            user_data = data.get('data') or {}
+            increments = data.get('increment') or {}  # e.g. {"score": 5}, added atomically
 
-            user = User.query.get(user_id)
-            if not user or user.secret != secret:
+            user_id = _authenticate(data.get('user_id'), data.get('secret'))
+            if not user_id:
                 return jsonify({'error': 'Unauthorized'}), 401
 
             # Validierung der Daten
-            filtered_data = {key: value for key, value in user_data.items() if key in ALLOWED_KEYS}
-            if len(filtered_data) != len(user_data):
-                invalid_keys = [key for key in user_data if key not in ALLOWED_KEYS]
+            if not isinstance(user_data, dict) or not isinstance(increments, dict) or not (user_data or increments):
+                return jsonify({'error': 'Missing data or increment'}), 400
+            invalid_keys = [key for key in list(user_data) + list(increments) if key not in ALLOWED_KEYS]
+            if invalid_keys:
                 return jsonify({'error': 'Invalid keys in data', 'invalid_keys': invalid_keys}), 400
+            if any(isinstance(amount, bool) or not isinstance(amount, (int, float)) for amount in increments.values()):
+                return jsonify({'error': 'Increments must be numbers'}), 400
+            if not set(increments) <= NUMERIC_KEYS:
+                return jsonify({'error': 'Only numeric keys can be incremented',
+                                'invalid_keys': sorted(set(increments) - NUMERIC_KEYS)}), 400
+            if any(isinstance(user_data[name], bool) or not isinstance(user_data[name], (int, float))
+                   for name in NUMERIC_KEYS & set(user_data)):
+                return jsonify({'error': 'Numeric keys must be set to numbers'}), 400
+            if set(user_data) & set(increments):
+                return jsonify({'error': 'A key cannot be set and incremented at once'}), 400
 
-            # Aktuelle Daten laden und mit gefilterten Daten mergen
-            current_data = user.data or {}  # Falls keine Daten vorhanden sind, ein leeres Dict verwenden
-            current_data.update(filtered_data)  # Nur die gegebenen Felder aktualisieren
-
-            # Speichern der aktualisierten Daten
-            user.data = current_data
+            # Nur die gegebenen Felder in der Datenbank aktualisieren, ohne die Daten vorher zu laden
+            current_data = _update_user_data(user_id, user_data, increments)
+            if current_data is None:
+                return jsonify({'error': 'User not found'}), 404
             db.session.commit()
 
-            LogSystem.log_info(f"User '{user.id}' updated data: {filtered_data}")
+            LogSystem.log_info("user_data_updated", user_id=user_id, data=user_data, increment=increments)
             return jsonify({'message': 'Data updated successfully', 'updated_data': current_data}), 200
         except Exception as e:
-            LogSystem.log_error(f"Error updating user data: {str(e)}. Request data: {request.json}")
+            LogSystem.log_error("user_data_update_failed", route='PUT /data', error=str(e),
+                                user_id=_body_field('user_id'))
             return jsonify({'error': str(e)}), 500
 
 
+# Tables of the admin exports: columns (the first one is the id), timestamp column for "since" and,
+# if the ids increase with every new row, whether "since_id" is supported (user IDs are random)
+EXPORTS = {
+    'users': ([User.id, User.username, User.coins, User.version, User.data, User.created_at],  # No password, secret
+              User.created_at, False),
+    'purchases': ([PurchaseHistory.id, PurchaseHistory.user_id, PurchaseHistory.product_name,
+                   PurchaseHistory.purchase_date], PurchaseHistory.purchase_date, True)
+}
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def _export_filters(table, since, since_id):
+    # Parses the "since" timestamp and the "since_id" of an export, raises ValueError if invalid
+    columns, _, increasing_ids = EXPORTS[table]
+    if since_id and not increasing_ids:
+        raise ValueError(f'The {table} export has no increasing id, use since')
+    return (datetime.fromisoformat(since) if since else None,
+            columns[0].type.python_type(since_id) if since_id else None)
+
+
+def export_rows(table, since=None, since_id=None):
+    """
+    Yields the rows of an export table as dicts, ordered by id, optionally only the ones
+    from `since` on and with an id above `since_id`. The rows are fetched
+    export_batch_size at a time (server-side cursor on PostgreSQL), so memory use stays
+    the same however large the table is.
+    """
+    columns, timestamp, _ = EXPORTS[table]
+    query = db.select(*columns).order_by(columns[0])
+    if since is not None:
+        query = query.where(timestamp >= since)
+    if since_id is not None:
+        query = query.where(columns[0] > since_id)
+    for row in db.session.execute(query.execution_options(yield_per=export_batch_size)):
+        yield {name: value.isoformat() if isinstance(value, datetime) else value
+               for name, value in row._mapping.items()}
+
+
+def export_chunks(table, export_format, rows):
+    # Renders rows as NDJSON or CSV, one chunk of text per export_batch_size rows
+    buffer = io.StringIO()
+    if export_format == 'csv':
+        writer = csv.DictWriter(buffer, [column.key for column in EXPORTS[table][0]])
+        writer.writeheader()
+    for count, row in enumerate(rows, 1):
+        if export_format == 'csv':
+            writer.writerow({name: json.dumps(value) if isinstance(value, (dict, list)) else value
+                             for name, value in row.items()})
+        else:
+            buffer.write(app.json.dumps(row) + '\n')
+        if count % export_batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@app.route('/export/<table>', methods=['GET'])
+def export(table):
+    """
+    Admin endpoint (X-Admin-Key header): streams the users or purchases table as NDJSON
+    (default) or CSV (?format=csv). ?since=<ISO timestamp> and, for purchases,
+    ?since_id=<id> export only the rows added after an earlier export.
+    """
+    try:
+        if not _is_admin():
+            return jsonify({'error': 'Forbidden'}), 403
+        if table not in EXPORTS:
+            return jsonify({'error': 'Unknown export'}), 404
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_MIMETYPES:
+            return jsonify({'error': 'Format must be ndjson or csv'}), 400
+        since, since_id = _export_filters(table, request.args.get('since'), request.args.get('since_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        LogSystem.log_error("export_failed", route='GET /export/<table>', error=str(e), table=table)
+        return jsonify({'error': str(e)}), 500
+
+    LogSystem.log_info("export_started", table=table, format=export_format, since=request.args.get('since'),
+                       since_id=request.args.get('since_id'))
+    chunks = export_chunks(table, export_format, export_rows(table, since, since_id))
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={table}.{export_format}'
+    return response
+
+
+@app.cli.command('export')
+@click.argument('table', type=click.Choice(list(EXPORTS)))
+@click.argument('target', type=click.File('w'), default='-')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_MIMETYPES)), default='ndjson')
+@click.option('--since', help='Only rows from this ISO timestamp on')
+@click.option('--since-id', help='Only rows with a higher id (purchases only)')
+def export_command(table, target, export_format, since, since_id):
+    """Writes the users or purchases table to TARGET (default: stdout) as NDJSON or CSV."""
+    try:
+        since, since_id = _export_filters(table, since, since_id)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    for chunk in export_chunks(table, export_format, export_rows(table, since, since_id)):
+        target.write(chunk)
+
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,180 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class CatalogCache:
+    def __init__(self, loader, ttl=60, max_stale=300, on_error=None):
+        """
+        Caches the result of `loader` in memory.
+
+        A value younger than `ttl` seconds is served directly. An older value is
+        still served for up to `max_stale` further seconds while a background
+        thread refreshes it (stale-while-revalidate). Anything older is loaded
+        synchronously. Errors of background refreshes are passed to `on_error`.
+        """
+        self.loader = loader
+        self.on_error = on_error
+        self.ttl = ttl
+        self.max_stale = max_stale
+
+        self._value = None
+        self._loaded_at = None
+        self._generation = 0
+        self._refreshing = False
+        self._lock = threading.Lock()  # Guards state and counters
+        self._load_lock = threading.Lock()  # Only one synchronous load at a time
+
+        # Counters
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.refresh_seconds_total = 0.0
+        self.last_refresh_seconds = None
+
+    def get(self):
+        """Returns the cached value, loading it if it is missing or too old."""
+        with self._lock:
+            value, age = self._current()
+            if age is not None and age < self.ttl:
+                self.hits += 1
+                return value
+            if age is not None and age < self.ttl + self.max_stale:
+                self.stale_hits += 1
+                start_refresh = not self._refreshing
+                self._refreshing = True
+            else:
+                start_refresh = None
+
+        if start_refresh is not None:
+            if start_refresh:
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+            return value
+
+        with self._load_lock:
+            # Another thread may have loaded the value while we were waiting
+            with self._lock:
+                value, age = self._current()
+                if age is not None and age < self.ttl:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+            return self._load()
+
+    def invalidate(self):
+        """Drops the cached value so the next call to get() loads it again."""
+        with self._lock:
+            self._value = None
+            self._loaded_at = None
+            self._generation += 1
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        with self._lock:
+            _, age = self._current()
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+                'refresh_seconds_total': self.refresh_seconds_total,
+                'last_refresh_seconds': self.last_refresh_seconds,
+                'age_seconds': age
+            }
+
+    def _current(self):
+        if self._loaded_at is None:
+            return None, None
+        return self._value, time.monotonic() - self._loaded_at
+
+    def _load(self):
+        with self._lock:
+            generation = self._generation
+        started = time.monotonic()
+        try:
+            value = self.loader()
+        except Exception:
+            with self._lock:
+                self.refresh_errors += 1
+            raise
+        finished = time.monotonic()
+
+        with self._lock:
+            self.refreshes += 1
+            self.last_refresh_seconds = finished - started
+            self.refresh_seconds_total += self.last_refresh_seconds
+            # Don't store a value that was loaded before an invalidation
+            if generation == self._generation:
+                self._value = value
+                self._loaded_at = finished
+        return value
+
+    def _refresh_in_background(self):
+        try:
+            self._load()
+        except Exception as e:
+            # Counted in refresh_errors, the stale value stays in place
+            if self.on_error:
+                self.on_error(e)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+class LRUCache:
+    def __init__(self, max_size=10000, ttl=60):
+        """
+        Thread-safe mapping that keeps at most `max_size` entries, evicting the least
+        recently used one, and treats entries older than `ttl` seconds as missing.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached value or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] >= self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries)
+            }
@@ -0,0 +1,43 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:  # Optional, without it only gzip is offered
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/plain', 'text/csv', 'text/html'}
+
+
+def available_encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def compress_response(response, accept_encodings, min_size=1024, gzip_level=6, brotli_quality=4):
+    """
+    Compresses the body of `response` with the best encoding the client accepts
+    (`accept_encodings` is request.accept_encodings): brotli if installed, otherwise
+    gzip. Bodies under `min_size` bytes, streamed responses, non-text content and
+    responses that are already encoded are left as they are. Returns the response.
+    """
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+    encoding = accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(body, quality=brotli_quality))
+    else:
+        response.set_data(gzip.compress(body, compresslevel=gzip_level, mtime=0))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed body isn't byte-identical to the uncompressed one, a strong ETag would claim that
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,51 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Optional, without it the standard json module is used
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that serializes with orjson if it is installed. Objects orjson
+    doesn't handle itself (e.g. datetimes, which Flask renders as HTTP dates) go through
+    the same `default` function as with Flask's provider. Calls with json.dumps
+    arguments and values orjson rejects (e.g. integers above 64 bit) fall back to the
+    standard json module. Unlike Flask's provider, keys are not sorted by default.
+    """
+
+    sort_keys = False
+
+    def _options(self, indent=False):
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        try:
+            body = orjson.dumps(obj, default=self.default,
+                                option=self._options(indent) | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            return super().response(obj)
+        return self._app.response_class(body, mimetype=self.mimetype)
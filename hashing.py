@@ -0,0 +1,101 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+
+def _stored_method(method):
+    # The method with all defaults filled in, as werkzeug writes it in front of the hash
+    name, *args = method.split(':')
+    if name == 'scrypt' and not args:
+        return f"scrypt:{2 ** 15}:8:1"
+    if name == 'pbkdf2' and len(args) < 2:
+        return f"pbkdf2:{args[0] if args else 'sha256'}:{DEFAULT_PBKDF2_ITERATIONS}"
+    return method
+
+
+def _hash_chunk(passwords, method):
+    return [generate_password_hash(password, method) for password in passwords]
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when more hash operations are waiting than the hasher accepts."""
+
+
+class PasswordHasher:
+    def __init__(self, method='pbkdf2:sha256:1000000', workers=None, max_pending=64):
+        """
+        Hashes and checks passwords in a pool of `workers` processes (default: one per
+        CPU), so the CPU-heavy key derivation doesn't block the request threads. With
+        `max_pending` operations queued or running, further calls raise
+        PasswordHasherBusy instead of waiting. `method` is a werkzeug hash method
+        including its cost, e.g. "pbkdf2:sha256:1000000" or "scrypt:32768:8:1".
+        The pool is started on first use, separately in every process.
+        """
+        self.method = method
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+    def _executor(self):
+        # A forked process (e.g. gunicorn --preload) can't use the pool of its parent
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def _run(self, func, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise PasswordHasherBusy()
+            self.pending += 1
+            executor = self._executor()
+        try:
+            return executor.submit(func, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords, chunk_size=10):
+        """
+        Hashes a list of passwords on all processes, `chunk_size` per task. Only one chunk
+        per process is queued at a time, so single hash() and check() calls still get a
+        turn between the chunks. Counts as one pending operation.
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise PasswordHasherBusy()
+            self.pending += 1
+            executor = self._executor()
+        try:
+            hashes = []
+            in_flight = deque()
+            for start in range(0, len(passwords), chunk_size):
+                in_flight.append(executor.submit(_hash_chunk, passwords[start:start + chunk_size], self.method))
+                if len(in_flight) >= self.workers:
+                    hashes.extend(in_flight.popleft().result())
+            while in_flight:
+                hashes.extend(in_flight.popleft().result())
+            return hashes
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def check(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if the hash was made with another method or cost than the current one."""
+        return password_hash.split('$', 1)[0] != _stored_method(self.method)
+
+    def shutdown(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown()
+        self._pool = None
@@ -1 +1,4 @@
 privat_stripe_api_key = 'Paste your private stripe api key here'
+token_signing_key = ''  # Paste a long random value (at least 32 characters) here to enable access and refresh tokens
+stripe_webhook_secret = ''  # Paste the signing secret of your Stripe webhook endpoint (whsec_...) here to enable it
+admin_api_key = ''  # Paste a long random value here to enable the admin endpoints (X-Admin-Key header)
@@ -1,52 +1,382 @@
 import os
+import atexit
+import gzip
+import itertools
+import json
 import logging
+import logging.handlers
+import queue
+import shutil
+import threading
+import time
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:  # Windows, where renaming a file another process has open fails instead
+    fcntl = None
+
+
+def _locked(path):
+    # True if a process holds the lock of an active log file, see RotatingLogFileHandler._open()
+    if fcntl is None:
+        return False
+    try:
+        with open(path, 'a') as stream:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    return False
+
+
+class RotatingLogFileHandler(logging.handlers.BaseRotatingHandler):
+    def __init__(self, filename, max_bytes=50 * 1024 * 1024, rotate_interval=24 * 3600, backup_count=30,
+                 retention_days=14, compress=True, batch=False):
+        """
+        Starts a new file when the current one reaches `max_bytes` or is older than
+        `rotate_interval` seconds (0 disables either trigger). Rotated files are
+        gzipped in a background thread. Of the rotated files in the folder, at most
+        `backup_count` per log file are kept and none older than `retention_days`.
+        Files left by processes that have exited are added to the rotated files.
+        With `batch` the file is only flushed by flush_batch(), not after every record.
+        """
+        super().__init__(filename, 'a', encoding='utf-8', delay=False)
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.retention_days = retention_days
+        self.compress = compress
+        self.batch = batch
+        self.rollover_at = time.time() + rotate_interval if rotate_interval else None
+        self._cleanup_threads = []
+
+    def _open(self):
+        stream = super()._open()
+        if fcntl is not None:
+            # Held while the file is active, so other processes can tell it from a file whose process exited
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return stream
+
+    def flush(self):
+        if not self.batch:
+            super().flush()
+
+    def flush_batch(self):
+        super().flush()
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        if self.max_bytes and self.stream.tell() >= self.max_bytes:
+            return True
+        return self.rollover_at is not None and time.time() >= self.rollover_at
+
+    def doRollover(self):
+        if self.stream:
+            super().flush()
+            self.stream.close()
+            self.stream = None
+        rotated = f"{self.baseFilename}.{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
+        if os.path.exists(rotated):
+            rotated += f".{int(time.time() * 1000) % 1000:03d}"
+        os.rename(self.baseFilename, rotated)
+        self.stream = self._open()
+        if self.rotate_interval:
+            self.rollover_at = time.time() + self.rotate_interval
+
+        # Compression and cleanup don't hold up the thread that writes the log
+        self._cleanup_threads = [t for t in self._cleanup_threads if t.is_alive()]
+        cleanup = threading.Thread(target=self._compress_and_prune, args=(rotated,), daemon=True)
+        cleanup.start()
+        self._cleanup_threads.append(cleanup)
+
+    def _compress(self, rotated):
+        with open(rotated, 'rb') as source, gzip.open(rotated + '.gz.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        modified = os.path.getmtime(rotated)
+        os.replace(rotated + '.gz.tmp', rotated + '.gz')
+        os.utime(rotated + '.gz', (modified, modified))  # Retention goes by the age of the log, not of the archive
+        os.remove(rotated)
+
+    def _adopt_orphaned_logs(self, folder):
+        # Active files of processes that have exited (e.g. before a restart) join the rotated files. They are
+        # told apart by the missing file lock, not by the PID in the name, containers reuse PIDs after a restart.
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if not name.endswith('.log') or path == self.baseFilename:
+                continue
+            if time.time() - os.path.getmtime(path) < 60 or _locked(path):  # Just created, or in use
+                continue
+            rotated = f"{path}.{datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d-%H-%M-%S')}"
+            try:
+                os.rename(path, rotated)
+            except OSError:  # Still open (Windows) or adopted by another process
+                continue
+            if self.compress:
+                self._compress(rotated)
+
+    def _compress_and_prune(self, rotated):
+        if self.compress:
+            self._compress(rotated)
+
+        folder = os.path.dirname(self.baseFilename)
+        self._adopt_orphaned_logs(folder)
+        prefix = os.path.basename(self.baseFilename) + '.'
+        oldest_allowed = time.time() - self.retention_days * 24 * 3600
+        own_backups = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if '.log.' not in name or name.endswith('.tmp'):
+                continue
+            if self.retention_days and os.path.getmtime(path) < oldest_allowed:
+                os.remove(path)
+            elif name.startswith(prefix):
+                own_backups.append(path)
+        if self.backup_count:
+            for path in sorted(own_backups, key=os.path.getmtime)[:-self.backup_count]:
+                os.remove(path)
+
+    def close(self):
+        for cleanup in self._cleanup_threads:
+            cleanup.join()
+        super().close()
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Human-readable format: the event followed by its fields as key=value pairs.
+    """
 
-class LogSystem:
     def __init__(self):
+        super().__init__("[%(asctime)s] %(levelname)s - %(message)s", "%d-%m-%Y %H:%M:%S")
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value!r}" if isinstance(value, str) else f"{key}={value}"
+                                   for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    JSON lines format: one object per record with time, level, event and all fields.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'event': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class OverflowQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue, overflow='block', sample_rate=10):
+        """
+        Puts records on a bounded queue. When the queue is full, `overflow` decides:
+        "block" waits for space, "drop" discards the record and "sample" keeps
+        warnings, errors and every `sample_rate`-th other record and discards the rest.
+        """
+        super().__init__(log_queue)
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self._overflow_counter = itertools.count()
+
+    def prepare(self, record):
+        # Formatting happens on the writer thread, request threads only enqueue
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == 'sample' and (record.levelno >= logging.WARNING or
+                                              next(self._overflow_counter) % self.sample_rate == 0):
+                self.queue.put(record)
+            else:
+                self.dropped += 1
+
+
+class BatchWriter(threading.Thread):
+    _STOP = object()
+
+    def __init__(self, log_queue, handler, batch_size=100, flush_interval=1.0):
+        """
+        Takes records off the queue and writes them with `handler`, flushing once
+        per batch of up to `batch_size` records or after `flush_interval` seconds.
+        """
+        super().__init__(name="LogWriter", daemon=True)
+        self.queue = log_queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is self._STOP:
+                    stopping = True
+                elif record.levelno >= self.handler.level:
+                    self.handler.handle(record)
+            self.handler.flush_batch()
+
+    def stop(self):
+        self.queue.put(self._STOP)
+        self.join()
+
+
+class LogSystem:
+    def __init__(self, background=True, queue_size=10000, overflow='block', sample_rate=10, batch_size=100,
+                 flush_interval=1.0, max_bytes=50 * 1024 * 1024, rotate_interval=24 * 3600, backup_count=30,
+                 retention_days=14, compress=True, log_format='text', name="ServerLogger", file_prefix=""):
+        """
+        With `background` enabled, log calls only put the record on a bounded queue and a
+        writer thread writes them to the file in batches. See OverflowQueueHandler for
+        `overflow` and `sample_rate`, BatchWriter for `batch_size` and `flush_interval`
+        and RotatingLogFileHandler for the rotation and retention settings. `log_format`
+        is "text" (TextFormatter) or "json" (JsonFormatter).
+
+        Every process writes to its own file with the PID in the name. A process that
+        is forked after the LogSystem was created (e.g. gunicorn --preload) switches to
+        a file of its own. Separate logs need their own logger `name` and `file_prefix`.
+        """
+        self.background = background
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.log_format = log_format
+        self.rotation = {
+            'max_bytes': max_bytes,
+            'rotate_interval': rotate_interval,
+            'backup_count': backup_count,
+            'retention_days': retention_days,
+            'compress': compress
+        }
+
         # Create log folder
         self.log_folder = os.path.join(os.getcwd(), "serverlogs")
         if not os.path.exists(self.log_folder):
             os.makedirs(self.log_folder)
 
-        # Generate log filename
-        log_filename = datetime.now().strftime("%Y-%m-%d-%H-%M-%S.log")
-        self.log_file_path = os.path.join(self.log_folder, log_filename)
-
         # Initialize logger
-        self.logger = logging.getLogger("ServerLogger")
+        self.file_prefix = file_prefix
+        self.logger = logging.getLogger(name)
         self.logger.setLevel(logging.DEBUG)  # Default log level
 
+        self.file_handler = None
+        self.queue_handler = None
+        self.writer = None
+        self._reopen_pending = False
+        self._reopen_lock = threading.Lock()
+        self._open_log()
+        atexit.register(self.close)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reopen_after_fork)
+
+    def _open_log(self):
+        # Generate log filename
+        log_filename = self.file_prefix + datetime.now().strftime(f"%Y-%m-%d-%H-%M-%S-{os.getpid()}.log")
+        self.log_file_path = os.path.join(self.log_folder, log_filename)
+
         # File handler
-        file_handler = logging.FileHandler(self.log_file_path)
+        file_handler = RotatingLogFileHandler(self.log_file_path, batch=self.background, **self.rotation)
         file_handler.setLevel(logging.DEBUG)
 
-        # Define log format (with custom date format)
-        formatter = logging.Formatter("[%(asctime)s] %(levelname)s - %(message)s", "%d-%m-%Y %H:%M:%S")
-        file_handler.setFormatter(formatter)
+        # Define log format
+        file_handler.setFormatter(JsonFormatter() if self.log_format == 'json' else TextFormatter())
+        self.file_handler = file_handler
 
         # Add handlers
-        self.logger.addHandler(file_handler)
+        if self.background:
+            log_queue = queue.Queue(maxsize=self.queue_size)
+            self.queue_handler = OverflowQueueHandler(log_queue, self.overflow, self.sample_rate)
+            self.writer = BatchWriter(log_queue, file_handler, self.batch_size, self.flush_interval)
+            self.writer.start()
+            self.logger.addHandler(self.queue_handler)
+        else:
+            self.logger.addHandler(file_handler)
+
+    def _reopen_after_fork(self):
+        # The writer thread doesn't exist in the child and the file belongs to the parent.
+        # Drop both without flushing, the parent writes its own buffered records. The new
+        # file is only created once the child logs, children that never do (e.g. the
+        # password hashing processes) leave no empty files behind.
+        self.logger.removeHandler(self.queue_handler or self.file_handler)
+        self.file_handler.stream = None
+        self._reopen_lock = threading.Lock()
+        self._reopen_pending = True
+
+    def _ensure_open(self):
+        if self._reopen_pending:
+            with self._reopen_lock:
+                if self._reopen_pending:
+                    self._open_log()
+                    self._reopen_pending = False
+
+    @property
+    def dropped(self):
+        """Number of records discarded because the queue was full."""
+        return self.queue_handler.dropped if self.queue_handler else 0
+
+    def close(self):
+        """Writes all queued records and closes the log file."""
+        if self.writer and self.writer.is_alive():
+            self.logger.removeHandler(self.queue_handler)
+            self.writer.stop()
+        else:
+            self.logger.removeHandler(self.file_handler)
+        self.file_handler.close()
 
     def initialize(self, description):
         """
         Initializes the log by writing the first entry in the log file
         with a description of the server or the test.
         """
+        self._ensure_open()
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.logger.info(f" Log initialized at {timestamp} ")
         self.logger.info(f" Description: {description} ")
 
-    def log_info(self, message):
-        """Logs an INFO level message."""
-        self.logger.info(f"{message}")
+    def log(self, level, event, **fields):
+        """
+        Logs an event name (or a plain message) with keyword fields. Nothing is
+        formatted here: the formatter renders the record on the writer thread, and
+        not at all if the level is filtered out.
+        """
+        if self.logger.isEnabledFor(level):
+            self._ensure_open()
+            self.logger.log(level, event, extra={'fields': fields})
 
-    def log_warning(self, message):
-        """Logs a WARNING level message."""
-        self.logger.warning(f"{message}")
+    def log_info(self, event, **fields):
+        """Logs an INFO level event."""
+        self.log(logging.INFO, event, **fields)
 
-    def log_error(self, message):
-        """Logs an ERROR level message."""
-        self.logger.error(f"{message}")
+    def log_warning(self, event, **fields):
+        """Logs a WARNING level event."""
+        self.log(logging.WARNING, event, **fields)
 
+    def log_error(self, event, **fields):
+        """Logs an ERROR level event."""
+        self.log(logging.ERROR, event, **fields)
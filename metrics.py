@@ -0,0 +1,139 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name + _format_labels(self.labelnames, key), value) for key, value in items]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(entry)) for key, entry in self._values.items()]
+        samples = []
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                samples.append((self.name + '_bucket' + _format_labels(self.labelnames, key, [('le', bound)]),
+                                cumulative))
+            samples.append((self.name + '_bucket' + _format_labels(self.labelnames, key, [('le', '+Inf')]),
+                            entry[-1]))
+            samples.append((self.name + '_sum' + _format_labels(self.labelnames, key), entry[-2]))
+            samples.append((self.name + '_count' + _format_labels(self.labelnames, key), entry[-1]))
+        return samples
+
+
+class Metrics:
+    """
+    Registry of counters, gauges and histograms that renders them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """
+        Adds a function that is called on every render() and returns a list of
+        (name, type, help, value) tuples, e.g. for counters kept by other objects.
+        """
+        self._collectors.append(collector)
+
+    @contextmanager
+    def timer(self, histogram, **labels):
+        """Observes the duration of the with-block in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+        for collector in self._collectors:
+            for name, metric_type, help_text, value in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,37 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_keys=100000):
+        """
+        One token bucket per key (e.g. a username or an IP address): a bucket holds up
+        to `burst` tokens and refills with `rate` tokens per second. Buckets that
+        haven't been used for the longest time are dropped beyond `max_keys`; a
+        dropped bucket starts full again.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """
+        Takes a token from the bucket of `key`. Returns 0 if that worked, otherwise the
+        seconds until the next token is available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
@@ -0,0 +1,153 @@
+import os
+import queue
+import threading
+import time
+
+
+class PeriodicTask:
+    def __init__(self, func, interval, on_error=None):
+        """
+        Runs `func` in a background thread when trigger() is called, at most once
+        every `interval` seconds and never twice at the same time. Errors are
+        passed to `on_error`.
+        """
+        self.func = func
+        self.interval = interval
+        self.on_error = on_error
+        self.attempted_at = None  # time.monotonic() of the last run
+        self._lock = threading.Lock()
+
+    def due(self):
+        return self.attempted_at is None or time.monotonic() - self.attempted_at >= self.interval
+
+    def trigger(self):
+        """Starts a run in the background if the task is due and not running."""
+        if not self.due() or not self._lock.acquire(blocking=False):
+            return False
+        self.attempted_at = time.monotonic()
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+
+    def _run(self):
+        try:
+            self.func()
+        except Exception as e:
+            if self.on_error:
+                self.on_error(e)
+        finally:
+            self._lock.release()
+
+
+class QueueWorker:
+    _STOP = object()
+
+    def __init__(self, handler, batch_size=100, flush_interval=0.5, on_error=None, name="QueueWorker"):
+        """
+        Passes the items put() on its queue to `handler` in lists of up to `batch_size`,
+        waiting at most `flush_interval` seconds for a batch to fill up. The background
+        thread is started by the first put(), in a forked process again. Errors of
+        `handler` are passed to `on_error` together with the batch.
+        """
+        self.handler = handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.name = name
+        self.queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        with self._lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue()  # The items queued in the parent are the parent's
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        self.queue.put(item)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if self._STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not self._STOP]
+            if not batch:
+                continue
+            try:
+                self.handler(batch)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e, batch)
+
+    def stop(self):
+        """Handles the items queued so far and stops the thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(self._STOP)
+            self._thread.join()
+
+
+class WorkerPool:
+    def __init__(self, run_once, workers=4, poll_interval=1.0, on_error=None, name="Worker"):
+        """
+        Runs `run_once` in a loop on `workers` background threads. `run_once` returns
+        True if it found work; otherwise the thread waits `poll_interval` seconds or
+        until wake() is called. The threads are started by start() or wake(), in a
+        forked process again. Errors are passed to `on_error`.
+        """
+        self.run_once = run_once
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.on_error = on_error
+        self.name = name
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts the threads unless they are running."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._threads = []
+                self._pid = os.getpid()
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers and not self._stopping.is_set():
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        """Starts the threads if necessary and lets the waiting threads look for work."""
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                found_work = self.run_once()
+            except Exception as e:
+                found_work = False
+                if self.on_error:
+                    self.on_error(e)
+            if not found_work:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def stop(self):
+        """Lets the threads finish their current run and stops them."""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
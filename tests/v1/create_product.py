@@ -1,4 +1,5 @@
 import requests
+import time
 
 # URL of the running Flask app
 BASE_URL = "http://127.0.0.1:5000"
@@ -15,9 +16,18 @@ def add_product():
 
     try:
         response = requests.post(url, json=product_data)
-        if response.status_code == 201:
-            print("Product created successfully!")
-            print("Response:", response.json())
+        if response.status_code == 202:
+            # The product is created in the background, poll the job until it is done
+            job = response.json()
+            while job["status"] in ("queued", "running"):
+                time.sleep(0.5)
+                job = requests.get(f"{BASE_URL}{response.headers['Location']}").json()
+            if job["status"] == "succeeded":
+                print("Product created successfully!")
+                print("Response:", job["result"])
+            else:
+                print(f"Failed to create product after {job['attempts']} attempts.")
+                print("Error:", job["error"])
         else:
             print(f"Failed to create product. Status code: {response.status_code}")
             print("Error:", response.json())
@@ -0,0 +1,63 @@
+import json
+import time
+import uuid
+import app
+import tests.test_users_infos as test_users_infos
+from werkzeug.security import generate_password_hash
+
+ACCOUNTS = 20  # Accounts per bulk request, every one costs a full password hash
+MIGRATED = 2000  # Accounts with existing password hashes imported with the CLI
+
+
+def main():
+    """
+    Creates accounts with POST /account/bulk, including invalid and duplicate usernames,
+    logs in with one of them, then imports accounts with existing password hashes with
+    "flask create-accounts". Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+    app.key.admin_api_key = uuid.uuid4().hex
+    headers = {"X-Admin-Key": app.key.admin_api_key}
+    prefix = f"bulk_user_{uuid.uuid4().hex[:6]}"
+
+    print("--- POST /account/bulk ---")
+    accounts = [{"username": f"{prefix}_{i}", "password": test_users_infos.password} for i in range(ACCOUNTS)]
+    assert client.post("/account/bulk", json=accounts).status_code == 403
+    assert client.post("/account/bulk", json=accounts, headers={"X-Admin-Key": "wrong"}).status_code == 403
+
+    body = accounts + [{"username": f"{prefix}_0", "password": "again"}, {"username": "", "password": "x"}]
+    started = time.perf_counter()
+    response = client.post("/account/bulk", json=body, headers=headers)
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.json
+    print(f"Created {response.json['created']} accounts in {elapsed:.2f} s, failed: {response.json['failed']}")
+    results = response.json["results"]
+    assert response.json["created"] == ACCOUNTS
+    assert results[-2]["error"] == "Duplicate username" and results[-1]["error"] == "Invalid username"
+
+    login = client.post("/login", json={"username": accounts[3]["username"], "password": test_users_infos.password})
+    assert login.status_code == 200 and login.json["user_id"] == results[3]["user_id"], login.json
+    print("Login with a bulk created account: OK")
+
+    response = client.post("/account/bulk", json=accounts[:2], headers=headers)
+    assert [result["error"] for result in response.json["results"]] == ["Username already exists"] * 2
+    print("Existing usernames rejected: OK")
+
+    print("\n--- flask create-accounts ---")
+    password_hash = generate_password_hash(test_users_infos.password, app.password_hash_method)
+    lines = [json.dumps({"username": f"{prefix}_migrated_{i}", "password_hash": password_hash})
+             for i in range(MIGRATED)]
+    started = time.perf_counter()
+    result = app.app.test_cli_runner().invoke(args=["create-accounts", "-"], input="\n".join(lines) + "\n")
+    elapsed = time.perf_counter() - started
+    assert result.exit_code == 0, result.output
+    created = [json.loads(line) for line in result.stdout.splitlines()]
+    assert len(created) == MIGRATED and all("user_id" in line for line in created)
+    print(f"Imported {MIGRATED} accounts with existing hashes in {elapsed:.2f} s")
+    login = client.post("/login", json={"username": f"{prefix}_migrated_7", "password": test_users_infos.password})
+    assert login.status_code == 200 and login.json["user_id"] == created[7]["user_id"], login.json
+    print("Login with a migrated account: OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import time
+import uuid
+import app
+import tests.test_users_infos as test_users_infos
+
+REQUESTS = 500  # Requests per endpoint and run
+
+
+def create_account(client):
+    response = client.post("/account", json={
+        "username": f"bench_user_{uuid.uuid4().hex[:6]}",
+        "password": test_users_infos.password
+    })
+    assert response.status_code == 201, response.json
+    return response.json["user_id"], response.json["secret"]
+
+
+def run(client, user_id, secret):
+    """
+    Sends REQUESTS requests to each authenticated endpoint and returns
+    {endpoint: (queries per request, milliseconds per request)}.
+    """
+    calls = {
+        "GET /account": lambda: client.get("/account", query_string={"user_id": user_id, "secret": secret}),
+        "PUT /account": lambda: client.put("/account", json={"user_id": user_id, "secret": secret,
+                                                             "action": "add", "amount": 1}),
+        "PUT /data": lambda: client.put("/data", json={"user_id": user_id, "secret": secret, "data": {"level": 1}}),
+    }
+    results = {}
+    for name, call in calls.items():
+        queries = 0
+        started = time.perf_counter()
+        for _ in range(REQUESTS):
+            response = call()
+            assert response.status_code == 200, response.json
+            queries += int(response.headers["X-Query-Count"])
+        elapsed = time.perf_counter() - started
+        results[name] = (queries / REQUESTS, elapsed / REQUESTS * 1000)
+    return results
+
+
+def main():
+    """
+    Compares queries and latency per request with the auth cache disabled (TTL 0) and enabled.
+    Runs in-process with the Flask test client, debug mode adds the X-Query-Count header.
+    """
+    app.app.debug = True
+    client = app.app.test_client()
+    user_id, secret = create_account(client)
+
+    ttl = app.auth_cache.ttl
+    app.auth_cache.ttl = 0
+    without_cache = run(client, user_id, secret)
+    app.auth_cache.ttl = ttl
+    with_cache = run(client, user_id, secret)
+
+    print(f"{'Endpoint':<14} {'Queries (no cache)':>19} {'Queries (cache)':>16} {'ms (no cache)':>14} {'ms (cache)':>11}")
+    for name in without_cache:
+        print(f"{name:<14} {without_cache[name][0]:>19.2f} {with_cache[name][0]:>16.2f} "
+              f"{without_cache[name][1]:>14.2f} {with_cache[name][1]:>11.2f}")
+    print(f"Auth cache: {app.auth_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import time
+from tests.v2.fake_stripe_server import FakeStripe
+import app
+
+fake = FakeStripe()
+
+
+def get_products(client, **params):
+    response = client.get("/product", query_string=params)
+    assert response.status_code == 200, response.json
+    return response.json
+
+
+def main():
+    """
+    Loads a catalog of 250 products (three Stripe pages) into the local tables,
+    changes it in the fake Stripe and checks that the incremental sync applies only the changes.
+    """
+    app.stripe.api_base = fake.start(port=0)  # Any free port, importing the script (pytest) starts nothing
+    client = app.app.test_client()
+
+    products = [fake.add_product(f"Item {i}", metadata={'coin_price': str(i)}) for i in range(250)]
+    for product in products:
+        fake.add_price(product['id'], 199)
+
+    print("--- Before the first sync ---")
+    app.catalog_sync_task.attempted_at = time.monotonic()  # No background syncs during the test
+    cached = get_products(client, limit=100, currency="eur")
+    assert len(cached['products']) == 100 and cached['has_more']
+    assert get_products(client, q="Item 249")['products'][0]['prices'][0]['unit_amount'] == 199
+    print("Cached Stripe catalog with filters and prices: OK")
+
+    print("\n--- Full sync ---")
+    with app.app.app_context():
+        app.sync_catalog(full=True)
+    app.catalog_sync_task.attempted_at = time.monotonic()  # No background syncs during the test
+    page = get_products(client, limit=100)
+    assert len(page['products']) == 100 and page['has_more']
+    assert page['products'][0]['prices'][0]['unit_amount'] == 199
+    page = get_products(client, limit=100, starting_after=page['products'][-1]['id'])
+    assert len(page['products']) == 100
+    assert get_products(client, limit=100, currency="eur") == cached, "Both sources must answer the same"
+    print("Full sync ok")
+
+    print("\n--- Incremental sync ---")
+    fake.update_product(products[0]['id'], name="Renamed item")
+    fake.delete_product(products[1]['id'])
+    new_product = fake.add_product("New item")
+    fake.add_price(new_product['id'], 499, currency='usd')
+    requests_before = fake.requests
+    with app.app.app_context():
+        app.sync_catalog()
+    print(f"Stripe requests for the incremental sync: {fake.requests - requests_before}")
+    assert fake.requests - requests_before == 1, "The incremental sync should only list the new events"
+
+    assert get_products(client, q="Renamed")['products'][0]['id'] == products[0]['id']
+    with app.app.app_context():
+        assert app.Product.query.get(products[1]['id']) is None
+    usd = get_products(client, currency="usd")['products']
+    assert [p['id'] for p in usd] == [new_product['id']]
+    print("Incremental sync ok")
+
+    print("\n--- Incremental sync without event cursor ---")
+    with app.app.app_context():
+        state = app.db.session.get(app.CatalogSyncState, 1)
+        state.last_event_id, state.last_event_created = None, int(time.time())
+        app.db.session.commit()
+    batch = [fake.add_product(f"Batch item {i}") for i in range(150)]  # More events than one page
+    with app.app.app_context():
+        app.sync_catalog()
+        mirrored = app.Product.query.filter(app.Product.name.like("Batch item %")).count()
+        state = app.db.session.get(app.CatalogSyncState, 1)
+        assert mirrored == len(batch), f"Only {mirrored} of {len(batch)} products mirrored"
+        assert state.last_event_id == fake.events[-1]['id'], "The cursor must be the newest event"
+    print("All events of the window applied: OK")
+
+    print("\n--- Quiet catalog ---")
+    with app.app.app_context():
+        state = app.db.session.get(app.CatalogSyncState, 1)
+        state.last_event_created -= app.STRIPE_EVENT_RETENTION - 3600  # Last change almost 30 days ago
+        last_full_sync = state.last_full_sync
+        app.db.session.commit()
+        app.sync_catalog()
+        state = app.db.session.get(app.CatalogSyncState, 1)
+        assert state.last_event_created >= time.time() - 60 and state.last_full_sync == last_full_sync
+    print("Sync without changes moves the cursor forward: OK")
+
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import random
+import threading
+import uuid
+import app
+import tests.test_users_infos as test_users_infos
+
+USERS = 5
+START_COINS = 100
+THREADS = 8  # Game servers settling rewards at the same time
+BATCHES = 20  # Batches per thread
+BATCH_SIZE = 50  # Operations per batch
+
+
+def create_users(client):
+    users = []
+    for _ in range(USERS):
+        response = client.post("/account", json={"username": f"batch_user_{uuid.uuid4().hex[:6]}",
+                                                 "password": test_users_infos.password})
+        assert response.status_code == 201, response.json
+        user = {"user_id": response.json["user_id"], "secret": response.json["secret"]}
+        response = client.put("/account", json={**user, "action": "add", "amount": START_COINS})
+        assert response.status_code == 200, response.json
+        users.append(user)
+    return users
+
+
+def balances(users):
+    with app.app.app_context():
+        coins = dict(app.db.session.query(app.User.id, app.User.coins).filter(
+            app.User.id.in_([user["user_id"] for user in users])))
+        ledger = dict(app.db.session.query(app.CoinTransaction.user_id, app.db.func.count()).filter(
+            app.CoinTransaction.user_id.in_(coins)).group_by(app.CoinTransaction.user_id))
+        rebuilt = {user_id: app.rebuild_coin_balance(user_id) for user_id in coins}
+    return coins, ledger, rebuilt
+
+
+def main():
+    """
+    Sends a batch with one failing operation in both modes and checks that "atomic" changes
+    nothing and "best_effort" applies the rest, then settles batches from several threads
+    at once and checks that the balances and ledger entries match the confirmed operations.
+    Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+    users = create_users(client)
+    operations = [{**user, "action": "add", "amount": 10} for user in users]
+    operations.append({**users[0], "action": "deduct", "amount": 10 * START_COINS})  # Not enough coins
+
+    print("--- Atomic ---")
+    before = balances(users)
+    response = client.post("/account/coins/batch", json={"operations": operations})
+    assert response.status_code == 400 and response.json["applied"] == 0, response.json
+    assert response.json["results"][0]["error"] == "Rolled back"
+    assert balances(users) == before, "An atomic batch with a failure must change nothing"
+    print("Failed batch rolled back, no ledger entries: OK")
+
+    print("\n--- Best effort ---")
+    response = client.post("/account/coins/batch", json={"operations": operations, "mode": "best_effort"})
+    assert response.status_code == 200 and response.json["applied"] == USERS, response.json
+    assert response.json["results"][-1]["error"] == "Not enough coins"
+    coins, ledger, rebuilt = balances(users)
+    assert all(coins[user["user_id"]] == START_COINS + 10 for user in users)
+    assert all(ledger[user_id] == before[1][user_id] + 1 for user_id in coins)
+    print("Valid operations applied, the failed one skipped: OK")
+
+    print("\n--- Concurrent batches ---")
+    before, confirmed, statuses = balances(users), [], []
+
+    def settle():
+        thread_client = app.app.test_client()
+        for _ in range(BATCHES):
+            batch = [{**random.choice(users), "action": random.choice(["add", "deduct"]),
+                      "amount": random.randint(1, 20)} for _ in range(BATCH_SIZE)]
+            response = thread_client.post("/account/coins/batch", json={"operations": batch, "mode": "best_effort"})
+            statuses.append(response.status_code)
+            if response.status_code == 200:
+                confirmed.extend((op, result) for op, result in zip(batch, response.json["results"])
+                                 if "coins" in result)
+
+    threads = [threading.Thread(target=settle) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"{len(statuses)} batches, statuses {sorted(set(statuses))}, {len(confirmed)} operations applied")
+    assert set(statuses) == {200}
+
+    coins, ledger, rebuilt = balances(users)
+    for user in users:
+        user_id = user["user_id"]
+        delta = sum(op["amount"] if op["action"] == "add" else -op["amount"]
+                    for op, _ in confirmed if op["user_id"] == user_id)
+        assert coins[user_id] == before[0][user_id] + delta >= 0, f"Balance of {user_id} is off"
+        assert ledger[user_id] == before[1][user_id] + sum(op["user_id"] == user_id for op, _ in confirmed)
+        assert rebuilt[user_id] == coins[user_id]
+    print("Balances and ledger match the confirmed operations: OK")
+
+
+if __name__ == "__main__":
+    main()
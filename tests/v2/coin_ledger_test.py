@@ -0,0 +1,39 @@
+import uuid
+import app
+import tests.test_users_infos as test_users_infos
+
+
+def main():
+    """
+    Gives two users coins from before the coin ledger existed, one of them changes its
+    coins afterwards, then backfills the opening balances and checks that the balances
+    rebuilt from the ledger match and "flask verify-coins" finds no mismatch.
+    Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+    users = []
+    for _ in range(2):
+        response = client.post("/account", json={"username": f"ledger_user_{uuid.uuid4().hex[:6]}",
+                                                 "password": test_users_infos.password})
+        assert response.status_code == 201, response.json
+        users.append({"user_id": response.json["user_id"], "secret": response.json["secret"]})
+    with app.app.app_context():
+        app.User.query.filter(app.User.id.in_([user["user_id"] for user in users])).update({"coins": 500})
+        app.db.session.commit()
+    response = client.put("/account", json={**users[1], "action": "deduct", "amount": 20})
+    assert response.status_code == 200, response.json
+
+    with app.app.app_context():
+        print(f"Backfilled {app.backfill_opening_balances()} balances")
+        assert app.backfill_opening_balances() == 0, "A second run must not change anything"
+        rebuilt = [app.rebuild_coin_balance(user["user_id"]) for user in users]
+    print(f"Rebuilt balances: {rebuilt}")
+    assert rebuilt == [500, 480]
+
+    result = app.app.test_cli_runner().invoke(args=["verify-coins"])
+    assert result.exit_code == 0 and "Balances with mismatches: 0" in result.output, result.output
+    print("Ledger matches the balances: OK")
+
+
+if __name__ == "__main__":
+    main()
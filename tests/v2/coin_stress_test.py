@@ -0,0 +1,81 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import tests.test_users_infos as test_users_infos
+
+# URL of the running Flask app
+BASE_URL = "http://127.0.0.1:5000"
+
+OPERATIONS = 2000  # Number of parallel coin operations
+WORKERS = 32  # Number of parallel clients
+START_COINS = 500
+
+
+def create_account():
+    """
+    Creates a fresh test account and gives it the start coins.
+    """
+    response = requests.post(f"{BASE_URL}/account", json={
+        "username": f"stress_user_{uuid.uuid4().hex[:6]}",
+        "password": test_users_infos.password
+    })
+    assert response.status_code == 201, response.text
+    account = response.json()
+    response = requests.put(f"{BASE_URL}/account", json={
+        "user_id": account["user_id"],
+        "secret": account["secret"],
+        "action": "add",
+        "amount": START_COINS
+    })
+    assert response.status_code == 200, response.text
+    return account["user_id"], account["secret"]
+
+
+def update_coins(session, user_id, secret, action, amount):
+    response = session.put(f"{BASE_URL}/account", json={
+        "user_id": user_id,
+        "secret": secret,
+        "action": action,
+        "amount": amount
+    })
+    return action, amount, response.status_code, response.json()
+
+
+def main():
+    """
+    Fires thousands of concurrent adds and deducts at one account and checks that the
+    final balance matches exactly the operations the server confirmed.
+    """
+    user_id, secret = create_account()
+    print(f"Created stress test user {user_id} with {START_COINS} coins")
+
+    # Twice as many deducts as adds, so the balance regularly hits zero
+    operations = [("add", 1) if i % 3 == 0 else ("deduct", 1) for i in range(OPERATIONS)]
+    sessions = [requests.Session() for _ in range(WORKERS)]
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        results = list(executor.map(
+            lambda args: update_coins(sessions[args[0] % WORKERS], user_id, secret, *args[1]),
+            enumerate(operations)))
+
+    expected = START_COINS
+    failed = 0
+    rejected = 0
+    for action, amount, status, body in results:
+        if status == 200:
+            expected += amount if action == "add" else -amount
+            assert body["coins"] >= 0, f"Negative balance returned: {body}"
+        elif status == 400 and body.get("error") == "Not enough coins":
+            rejected += 1
+        else:
+            failed += 1
+
+    response = requests.get(f"{BASE_URL}/account", params={"user_id": user_id, "secret": secret})
+    coins = response.json()["coins"]
+    print(f"Operations: {OPERATIONS}, rejected (not enough coins): {rejected}, failed: {failed}")
+    print(f"Expected balance: {expected}, actual balance: {coins}")
+    assert coins == expected, "Final balance does not match the confirmed operations"
+    print("Stress test passed!")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import requests
+import time
 import uuid
+import key
 import tests.test_users_infos as pwf
 
 # Base URL of the application from app.py
 BASE_URL = "http://127.0.0.1:5000"
+BATCH_SIZE = 1000  # Accounts per /account/bulk request (account_bulk_max_size in app.py)
 
 # Local test_users_infos list to temporarily store created account data
 test_users_infos = []
@@ -20,8 +23,11 @@ def create_account(username, password):
     }
 
     try:
-        # Sending the POST request
+        # Sending the POST request, waiting as long as the rate limit of the server asks for
         response = requests.post(url, json=account_data)
+        while response.status_code in (429, 503):
+            time.sleep(int(response.headers.get("Retry-After", 1)))
+            response = requests.post(url, json=account_data)
 
         # Handling status 201 for successful creation
         if response.status_code == 201:
@@ -46,9 +52,36 @@ def create_account(username, password):
         return None
 
 
+def create_accounts_bulk(accounts):
+    """
+    Creates up to 1000 accounts with one POST request to the /account/bulk admin route in app.py.
+    """
+    url = f"{BASE_URL}/account/bulk"
+    try:
+        response = requests.post(url, json=accounts, headers={"X-Admin-Key": key.admin_api_key})
+        while response.status_code == 503:
+            time.sleep(int(response.headers.get("Retry-After", 1)))
+            response = requests.post(url, json=accounts, headers={"X-Admin-Key": key.admin_api_key})
+
+        if response.status_code == 200:
+            for result in response.json()["results"]:
+                if "error" in result:
+                    print(f"Failed to create {result['username']}: {result['error']}")
+            return [{"user_id": result["user_id"], "secret": result["secret"]}
+                    for result in response.json()["results"] if "user_id" in result]
+        else:
+            print(f"Failed to create accounts. Status code: {response.status_code}")
+            print("Response text:", response.text)
+            return []
+    except requests.RequestException as e:
+        print(f"An error occurred: {e}")
+        return []
+
+
 def bulk_create_accounts():
     """
-    Prompts the user for the number of accounts to create, then creates them.
+    Prompts the user for the number of accounts to create, then creates them in batches of
+    1000 with /account/bulk, or one by one with /account if key.admin_api_key is not set.
     """
     try:
         # Prompt user for number of accounts to create
@@ -62,13 +95,19 @@ def bulk_create_accounts():
         return
 
     print(f"Creating {num_accounts} accounts...\n")
-    for i in range(num_accounts):
-        username = f"test_user_{uuid.uuid4().hex[:6]}"
-        password = pwf.password
-        print(f"Creating account {i + 1} with username: {username} and password: {password}...")
-        account_data = create_account(username, password)
-        if account_data:
-            test_users_infos.append(account_data)  # Store account data locally
+    accounts = [{"username": f"test_user_{uuid.uuid4().hex[:6]}", "password": pwf.password}
+                for _ in range(num_accounts)]
+    if key.admin_api_key:
+        for start in range(0, num_accounts, BATCH_SIZE):
+            print(f"Creating accounts {start + 1} to {min(start + BATCH_SIZE, num_accounts)}...")
+            test_users_infos.extend(create_accounts_bulk(accounts[start:start + BATCH_SIZE]))
+    else:
+        for i, account in enumerate(accounts):
+            print(f"Creating account {i + 1} with username: {account['username']} "
+                  f"and password: {account['password']}...")
+            account_data = create_account(account["username"], account["password"])
+            if account_data:
+                test_users_infos.append(account_data)  # Store account data locally
 
     # Final output
     print("\nAccount creation completed!")
@@ -0,0 +1,54 @@
+import threading
+import uuid
+import app
+import tests.test_users_infos as test_users_infos
+
+THREADS = 8  # Concurrent writers
+INCREMENTS = 50  # Increments of the score per writer
+
+
+def main():
+    """
+    Sets keys of the user data and increments the score from several threads at once.
+    No increment may get lost and the other keys must stay untouched, and keys without
+    numbers can't be incremented.
+    Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+    response = client.post("/account", json={"username": f"data_user_{uuid.uuid4().hex[:6]}",
+                                              "password": test_users_infos.password})
+    assert response.status_code == 201, response.json
+    credentials = {"user_id": response.json["user_id"], "secret": response.json["secret"]}
+
+    response = client.put("/data", json={**credentials, "data": {"level": 1, "preferences": {"sound": True}}})
+    assert response.status_code == 200, response.json
+
+    def writer():
+        writer_client = app.app.test_client()
+        for _ in range(INCREMENTS):
+            result = writer_client.put("/data", json={**credentials, "increment": {"score": 1}})
+            assert result.status_code == 200, result.json
+
+    threads = [threading.Thread(target=writer) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    # Meanwhile another key is changed, this must neither block nor undo the increments
+    response = client.put("/data", json={**credentials, "data": {"level": 2}})
+    assert response.status_code == 200, response.json
+    for thread in threads:
+        thread.join()
+
+    data = client.get("/data", query_string={"user_id": credentials["user_id"]}).json["data"]
+    print(f"Data after {THREADS * INCREMENTS} increments: {data}")
+    assert data == {"level": 2, "preferences": {"sound": True}, "score": THREADS * INCREMENTS}
+
+    # Only numbers can be incremented, the preferences object must stay as it is
+    response = client.put("/data", json={**credentials, "increment": {"preferences": 1}})
+    assert response.status_code == 400 and response.json["invalid_keys"] == ["preferences"], response.json
+    assert client.put("/data", json={**credentials, "data": {"score": "high"}}).status_code == 400
+    assert client.get("/data", query_string={"user_id": credentials["user_id"]}).json["data"] == data
+    print("Increment of a non-numeric key rejected: OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import uuid
+import app
+import tests.test_users_infos as test_users_infos
+
+
+def main():
+    """
+    Checks the ETags of GET /data and GET /account: an unchanged user gets a 304 without
+    a body, every change of data or coins leads to a new ETag and a full response.
+    Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+    response = client.post("/account", json={"username": f"etag_user_{uuid.uuid4().hex[:6]}",
+                                              "password": test_users_infos.password})
+    assert response.status_code == 201, response.json
+    credentials = {"user_id": response.json["user_id"], "secret": response.json["secret"]}
+
+    for path, change in (
+            ("/data", lambda: client.put("/data", json={**credentials, "increment": {"score": 1}})),
+            ("/account", lambda: client.put("/account", json={**credentials, "action": "add", "amount": 1}))):
+        response = client.get(path, query_string=credentials)
+        assert response.status_code == 200, response.json
+        etag = response.headers["ETag"]
+
+        response = client.get(path, query_string=credentials, headers={"If-None-Match": etag})
+        assert response.status_code == 304 and not response.data
+
+        assert change().status_code == 200
+        response = client.get(path, query_string=credentials, headers={"If-None-Match": etag})
+        assert response.status_code == 200 and response.headers["ETag"] != etag, response.json
+        print(f"GET {path}: 304 while unchanged, new ETag after a change: OK")
+
+
+if __name__ == "__main__":
+    main()
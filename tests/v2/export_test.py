@@ -0,0 +1,83 @@
+import csv
+import io
+import json
+import os
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+import app
+
+PURCHASES = 20000  # Purchase history rows added for the export
+
+
+def main():
+    """
+    Adds purchases to a user, exports them with GET /export/purchases as NDJSON and CSV,
+    exports only the newer ones with since_id and since, checks that the users export has
+    no passwords or secrets and exports the users created since a timestamp, and that the
+    CLI export's memory doesn't grow with the table. Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+    app.key.admin_api_key = uuid.uuid4().hex
+    headers = {"X-Admin-Key": app.key.admin_api_key}
+
+    user = client.post("/account", json={"username": f"export_user_{uuid.uuid4().hex[:6]}", "password": "x"}).json
+    started_at = datetime(2030, 1, 1)
+    with app.app.app_context():
+        last_id = app.db.session.query(app.db.func.max(app.PurchaseHistory.id)).scalar() or 0
+        app.db.session.execute(app.db.insert(app.PurchaseHistory), [
+            {"user_id": user["user_id"], "product_name": f"Item {i}", "purchase_date": started_at + timedelta(minutes=i)}
+            for i in range(PURCHASES)])
+        app.db.session.commit()
+
+    print("--- NDJSON ---")
+    assert client.get("/export/purchases").status_code == 403
+    started = time.perf_counter()
+    response = client.get("/export/purchases", query_string={"since_id": last_id}, headers=headers)
+    assert response.status_code == 200 and response.is_streamed
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    print(f"Exported {len(rows)} purchases in {time.perf_counter() - started:.2f} s")
+    assert len(rows) == PURCHASES and rows[-1]["product_name"] == f"Item {PURCHASES - 1}"
+
+    print("\n--- CSV, incremental ---")
+    response = client.get("/export/purchases", headers=headers,
+                          query_string={"format": "csv", "since_id": rows[-11]["id"]})
+    newer = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [int(row["id"]) for row in newer] == [row["id"] for row in rows[-10:]]
+    response = client.get("/export/purchases", headers=headers,
+                          query_string={"since": (started_at + timedelta(minutes=PURCHASES - 5)).isoformat()})
+    assert len(response.get_data(as_text=True).splitlines()) == 5
+    assert client.get("/export/users", query_string={"since_id": user["user_id"]}, headers=headers).status_code == 400
+    print("since_id and since: OK")
+
+    print("\n--- Users ---")
+    users = [json.loads(line) for line in client.get("/export/users", headers=headers).get_data(as_text=True).splitlines()]
+    assert user["user_id"] in {row["id"] for row in users}
+    assert not {"password", "secret"} & set(users[0])
+    print(f"Exported {len(users)} users without passwords and secrets: OK")
+
+    since = datetime.utcnow().isoformat()
+    with app.app.app_context():
+        created = app.create_accounts([{"username": f"export_new_{uuid.uuid4().hex[:8]}", "password_hash": "x"}
+                                       for _ in range(20)])
+    response = client.get("/export/users", query_string={"since": since}, headers=headers)
+    new_users = [json.loads(line)["id"] for line in response.get_data(as_text=True).splitlines()]
+    assert sorted(new_users) == sorted(result["user_id"] for result in created), f"Got {len(new_users)} of 20"
+    print("Users created since the last export: OK")
+
+    print("\n--- flask export ---")
+    runner = app.app.test_cli_runner()
+    peaks = []
+    for since_id in (last_id + PURCHASES - 1000, last_id):
+        tracemalloc.start()
+        result = runner.invoke(args=["export", "purchases", os.devnull, "--since-id", str(since_id)])
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert result.exit_code == 0, result.output
+    print(f"Peak memory for 1000 rows: {peaks[0] / 1024:.0f} KiB, for {PURCHASES} rows: {peaks[1] / 1024:.0f} KiB")
+    assert peaks[1] < 2 * peaks[0], "Memory must not grow with the number of rows"
+
+
+if __name__ == "__main__":
+    main()
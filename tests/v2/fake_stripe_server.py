@@ -0,0 +1,196 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+# Port of the fake Stripe API. Start the app with STRIPE_API_BASE=http://127.0.0.1:12111
+PORT = 12111
+
+
+def parse_form(pairs):
+    """
+    Turns Stripe's form encoding (metadata[key]=value, types[0]=value) into nested dicts and lists.
+    """
+    result = {}
+    for name, value in pairs:
+        keys = name.replace(']', '').split('[')
+        target = result
+        for part in keys[:-1]:
+            target = target.setdefault(part, {})
+        target[keys[-1]] = value
+
+    def convert(value):
+        if isinstance(value, dict):
+            if value and all(k.isdigit() for k in value):
+                return [convert(value[k]) for k in sorted(value, key=int)]
+            return {k: convert(v) for k, v in value.items()}
+        return value
+
+    return convert(result)
+
+
+class FakeStripe:
+    """
+    In-memory product, price and event store that answers like the Stripe API.
+    """
+
+    def __init__(self):
+        self.products = {}
+        self.prices = {}
+        self.events = []
+        self.requests = 0
+        self.rate_limit_every = 0  # If set, every n-th POST is answered with 429 like Stripe's rate limiter
+        self.idempotent_responses = {}  # Idempotency-Key -> response of the first request
+        self.failing_prices = 0  # Number of the next price creations that fail with a 500
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _id(self, prefix):
+        return f"{prefix}_{next(self._ids):06d}"
+
+    def _event(self, event_type, obj):
+        self.events.append({
+            'id': self._id('evt'),
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()),
+            'data': {'object': dict(obj)}
+        })
+
+    def add_product(self, name, description='', metadata=None, active=True):
+        with self._lock:
+            now = int(time.time())
+            product = {'id': self._id('prod'), 'object': 'product', 'name': name, 'description': description,
+                       'active': active, 'metadata': metadata or {}, 'created': now, 'updated': now}
+            self.products[product['id']] = product
+            self._event('product.created', product)
+            return product
+
+    def update_product(self, product_id, **fields):
+        with self._lock:
+            product = self.products[product_id]
+            product.update(fields, updated=int(time.time()))
+            self._event('product.updated', product)
+            return product
+
+    def delete_product(self, product_id):
+        with self._lock:
+            product = self.products.pop(product_id)
+            for price_id in [p['id'] for p in self.prices.values() if p['product'] == product_id]:
+                del self.prices[price_id]
+            self._event('product.deleted', {'id': product_id, 'object': 'product', 'deleted': True})
+            return product
+
+    def add_price(self, product_id, unit_amount, currency='eur', recurring=None, tax_behavior='exclusive'):
+        with self._lock:
+            price = {'id': self._id('price'), 'object': 'price', 'product': product_id,
+                     'unit_amount': int(unit_amount), 'currency': currency, 'recurring': recurring,
+                     'tax_behavior': tax_behavior, 'active': True, 'created': int(time.time())}
+            self.prices[price['id']] = price
+            self._event('price.created', price)
+            return price
+
+    def list(self, objects, params):
+        """Newest first with limit, starting_after and ending_before, like every Stripe list endpoint."""
+        with self._lock:
+            items = sorted(objects, key=lambda o: (o['created'], o['id']), reverse=True)
+            if 'types' in params:
+                items = [o for o in items if o['type'] in params['types']]
+            created = params.get('created', {})
+            if 'gte' in created:
+                items = [o for o in items if o['created'] >= int(created['gte'])]
+            if 'gt' in created:
+                items = [o for o in items if o['created'] > int(created['gt'])]
+            limit = int(params.get('limit', 10))
+            ids = [o['id'] for o in items]
+            if 'ending_before' in params:
+                items = items[:ids.index(params['ending_before'])]
+                return {'object': 'list', 'data': items[-limit:], 'has_more': len(items) > limit}
+            if 'starting_after' in params:
+                items = items[ids.index(params['starting_after']) + 1:]
+            return {'object': 'list', 'data': items[:limit], 'has_more': len(items) > limit}
+
+    def start(self, port=PORT):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                fake.requests += 1
+                url = urlparse(self.path)
+                params = parse_form(parse_qsl(url.query))
+                sources = {'/v1/products': lambda: fake.products.values(),
+                           '/v1/prices': lambda: fake.prices.values(),
+                           '/v1/events': lambda: fake.events}
+                if url.path not in sources:
+                    return self._send(404, {'error': {'message': f"Unknown path {url.path}"}})
+                self._send(200, fake.list(list(sources[url.path]()), params))
+
+            def do_POST(self):
+                with fake._lock:
+                    fake.requests += 1
+                    rate_limited = fake.rate_limit_every and fake.requests % fake.rate_limit_every == 0
+                length = int(self.headers.get('Content-Length', 0))
+                params = parse_form(parse_qsl(self.rfile.read(length).decode()))
+                if rate_limited:
+                    return self._send(429, {'error': {'type': 'invalid_request_error', 'code': 'rate_limit',
+                                                      'message': 'Too many requests'}})
+                key = self.headers.get('Idempotency-Key')
+                if key in fake.idempotent_responses:
+                    return self._send(200, fake.idempotent_responses[key])
+                if self.path == '/v1/prices' and fake.failing_prices:
+                    fake.failing_prices -= 1
+                    self.send_response(500)
+                    self.send_header('Stripe-Should-Retry', 'false')  # Leave retrying to the caller
+                    self.send_header('Content-Type', 'application/json')
+                    self.end_headers()
+                    self.wfile.write(json.dumps({'error': {'type': 'api_error', 'message': 'Failure'}}).encode())
+                    return
+                if self.path == '/v1/products':
+                    body = fake.add_product(params['name'], params.get('description', ''), params.get('metadata'))
+                elif self.path.startswith('/v1/products/'):
+                    fields = {k: v == 'true' if k == 'active' else v for k, v in params.items()}
+                    body = fake.update_product(self.path[len('/v1/products/'):], **fields)
+                elif self.path == '/v1/prices':
+                    body = fake.add_price(
+                        params['product'], params['unit_amount'], params.get('currency', 'eur'),
+                        params.get('recurring'), params.get('tax_behavior', 'exclusive'))
+                else:
+                    return self._send(404, {'error': {'message': f"Unknown path {self.path}"}})
+                if key:
+                    fake.idempotent_responses[key] = body
+                self._send(200, body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)  # Port 0: any free port
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+
+
+if __name__ == "__main__":
+    fake = FakeStripe()
+    for i in range(3):
+        p = fake.add_product(f"Coins {i + 1}", metadata={'coin_price': str((i + 1) * 100)})
+        fake.add_price(p['id'], (i + 1) * 199)
+    print(f"Fake Stripe API running at {fake.start()}. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,96 @@
+import threading
+import uuid
+from datetime import datetime
+import app
+import tests.test_users_infos as test_users_infos
+
+THREADS = 10  # Concurrent retries of the same request
+
+
+def main():
+    """
+    Repeats account creations and coin updates with the same Idempotency-Key, sequentially
+    and concurrently, and checks that they are applied once and the first response is
+    replayed. Finally the expired keys are purged. Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+
+    print("--- POST /account ---")
+    body = {"username": f"idem_user_{uuid.uuid4().hex[:6]}", "password": test_users_infos.password}
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    first = client.post("/account", json=body, headers=headers)
+    assert first.status_code == 201, first.json
+    hashes = app.password_hash_seconds.samples()
+    retry = client.post("/account", json=body, headers=headers)
+    assert retry.status_code == 201 and retry.json == first.json
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert app.password_hash_seconds.samples() == hashes, "A replay must not hash the password again"
+    print("Retry got the same account without hashing: OK")
+    credentials = {"user_id": first.json["user_id"], "secret": first.json["secret"]}
+
+    print("\n--- PUT /account ---")
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    statuses = []
+
+    def retry_add():
+        thread_client = app.app.test_client()
+        response = thread_client.put("/account", json={**credentials, "action": "add", "amount": 10},
+                                     headers=headers)
+        statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=retry_add) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    retry_add()
+    print(f"Statuses of {THREADS + 1} requests with the same key: {sorted(statuses)}")
+    coins = client.get("/account", query_string=credentials).json["coins"]
+    assert coins == 10, f"Coins were added {coins // 10} times"
+
+    response = client.put("/account", json={**credentials, "action": "add", "amount": 99}, headers=headers)
+    assert response.status_code == 422, response.json
+    print("Coins added once, key can't be reused for another request: OK")
+
+    print("\n--- Rate limited and failed requests ---")
+    rate_limited = app._rate_limited
+    app._rate_limited = lambda username=None: (app.jsonify({"error": "Too many attempts"}), 429)
+    body = {"username": f"idem_user_{uuid.uuid4().hex[:6]}", "password": test_users_infos.password}
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    assert client.post("/account", json=body, headers=headers).status_code == 429
+    app._rate_limited = rate_limited
+    response = client.post("/account", json=body, headers=headers)
+    assert response.status_code == 201 and "Idempotent-Replayed" not in response.headers, response.json
+    print("Retry after a 429 is run, not replayed: OK")
+
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    body = {**credentials, "action": "add", "amount": 5}
+    trigger = app.coin_snapshot_task.trigger
+    app.coin_snapshot_task.trigger = lambda: 1 / 0  # The request fails after its commit
+    assert client.put("/account", json=body, headers=headers).status_code == 500
+    app.coin_snapshot_task.trigger = trigger
+    response = client.put("/account", json=body, headers=headers)
+    assert response.status_code == 200 and response.headers["Idempotent-Replayed"] == "true", response.json
+    assert client.get("/account", query_string=credentials).json["coins"] == coins + 5
+    print("Response stored with the change, a retry after a failure is replayed: OK")
+
+    with app.app.app_context():
+        # As if the process had died while the request was running
+        app.IdempotencyRecord.query.filter_by(key=headers["Idempotency-Key"]).update({"status_code": None})
+        app.db.session.commit()
+    response = client.put("/account", json=body, headers=headers)
+    assert response.status_code == 409 and response.headers["Retry-After"], response.json
+    assert client.get("/account", query_string=credentials).json["coins"] == coins + 5
+    print("Reservation of a crashed request is not run again: OK")
+
+    print("\n--- Purge ---")
+    with app.app.app_context():
+        app.IdempotencyRecord.query.update({"expires_at": datetime(2000, 1, 1)})
+        app.db.session.commit()
+        deleted = app.purge_idempotency_records()
+        assert app.IdempotencyRecord.query.count() == 0
+    print(f"Purged {deleted} expired keys: OK")
+
+
+if __name__ == "__main__":
+    main()
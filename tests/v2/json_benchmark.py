@@ -0,0 +1,60 @@
+import gzip
+import time
+from flask.json.provider import DefaultJSONProvider
+import app
+import compression
+from fastjson import OrjsonProvider
+from tests.v2.fake_stripe_server import FakeStripe
+
+REPEAT = 200  # Serializations per payload and provider
+PRODUCTS = 100  # Products in the /product payload, the maximum page size
+
+
+def product_payload():
+    # Same shape as GET /product: Stripe products with their prices
+    stripe = FakeStripe()
+    products = []
+    for i in range(PRODUCTS):
+        product = stripe.add_product(f"Product {i}", description=f"Description of product {i} " * 4,
+                                     metadata={'coin_price': str(100 + i), 'category': 'skins'})
+        prices = [stripe.add_price(product['id'], 199 + i, currency) for currency in ('eur', 'usd', 'gbp')]
+        products.append({**product, 'prices': prices})
+    return {'products': products, 'has_more': False}
+
+
+def account_payload():
+    # Same shape as GET /account with the most recent purchases
+    return {
+        'username': 'bench_user',
+        'coins': 1250,
+        'purchase_count': 42,
+        'purchases': [{'product_name': f"Product {i}", 'purchase_date': '2026-10-18T12:00:00.000000'}
+                      for i in range(app.account_recent_purchases)]
+    }
+
+
+def serialize_ms(provider, payload):
+    started = time.perf_counter()
+    for _ in range(REPEAT):
+        body = provider.response(payload).get_data()
+    return (time.perf_counter() - started) / REPEAT * 1000, body
+
+
+def main():
+    """
+    Compares Flask's standard JSON provider with the orjson provider (time per
+    serialization) and the bytes on the wire uncompressed, with gzip and with brotli.
+    """
+    providers = {'json': DefaultJSONProvider(app.app), 'orjson': OrjsonProvider(app.app)}
+    print(f"{'Payload':<10} {'Provider':<8} {'ms':>8} {'bytes':>8} {'gzip':>8} {'brotli':>8}")
+    for name, payload in (('/product', product_payload()), ('/account', account_payload())):
+        for provider_name, provider in providers.items():
+            ms, body = serialize_ms(provider, payload)
+            brotli_size = len(compression.brotli.compress(body, quality=4)) if compression.brotli else '-'
+            print(f"{name:<10} {provider_name:<8} {ms:>8.3f} {len(body):>8} "
+                  f"{len(gzip.compress(body, compresslevel=6)):>8} {brotli_size:>8}")
+    print(f"Responses under {app.compression_min_size} bytes are sent uncompressed")
+
+
+if __name__ == "__main__":
+    main()
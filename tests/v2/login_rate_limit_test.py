@@ -0,0 +1,69 @@
+import uuid
+import app
+import tests.test_users_infos as test_users_infos
+
+ATTEMPTS = 10  # Wrong logins for one username, more than login_burst_per_username
+
+
+def create_account(client):
+    username = f"limit_user_{uuid.uuid4().hex[:6]}"
+    response = client.post("/account", json={"username": username, "password": test_users_infos.password})
+    assert response.status_code == 201, response.json
+    return username, response.json["user_id"]
+
+
+def stored_hash(user_id):
+    with app.app.app_context():
+        return app.db.session.get(app.User, user_id).password
+
+
+def main():
+    """
+    Checks the rehash on login, the per-username rate limit and the 503 when the
+    password hasher is overloaded. Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+
+    # Rehash: a changed hash method is applied on the next successful login
+    username, user_id = create_account(client)
+    method = app.password_hasher.method
+    app.password_hasher.method = "pbkdf2:sha256:600000"
+    response = client.post("/login", json={"username": username, "password": test_users_infos.password})
+    assert response.status_code == 200, response.json
+    assert stored_hash(user_id).startswith("pbkdf2:sha256:600000$")
+    app.password_hasher.method = method
+    response = client.post("/login", json={"username": username, "password": test_users_infos.password})
+    assert response.status_code == 200, response.json
+    assert stored_hash(user_id).startswith(method + "$")
+    print("Rehash on login: OK")
+
+    # A method without an explicit cost matches the hashes made with its default cost
+    password_hash = stored_hash(user_id)
+    app.password_hasher.method = "pbkdf2"
+    response = client.post("/login", json={"username": username, "password": test_users_infos.password})
+    app.password_hasher.method = method
+    assert response.status_code == 200, response.json
+    assert stored_hash(user_id) == password_hash, "A hash with the default cost must not be renewed"
+    print("No rehash for a method with the default cost: OK")
+
+    # Rate limit: after the burst further attempts get a 429 without a password check
+    statuses = []
+    for _ in range(ATTEMPTS):
+        response = client.post("/login", json={"username": username, "password": "wrong"})
+        statuses.append(response.status_code)
+    print(f"Statuses of {ATTEMPTS} wrong logins: {statuses}")
+    assert statuses.count(401) <= app.login_burst_per_username
+    assert statuses[-1] == 429 and int(response.headers["Retry-After"]) >= 1
+
+    # Overload: without free capacity in the hasher the request is refused right away
+    other_username, _ = create_account(client)
+    max_pending = app.password_hasher.max_pending
+    app.password_hasher.max_pending = 0
+    response = client.post("/login", json={"username": other_username, "password": test_users_infos.password})
+    app.password_hasher.max_pending = max_pending
+    assert response.status_code == 503, response.json
+    print("503 when the hasher is busy: OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import json
+import time
+import uuid
+from decimal import Decimal
+from tests.v2.fake_stripe_server import FakeStripe
+import app
+
+fake = FakeStripe()
+
+PRODUCTS = 300  # Products of the season catalog
+
+
+def season_catalog(season):
+    return [{'name': f"{season} item {i}", 'description': f"Item {i} of the {season} season",
+             'price': 1.99 + i, 'metadata': {'coin_price': str(100 + i)}} for i in range(PRODUCTS)]
+
+
+def main():
+    """
+    Imports a season catalog with POST /product/bulk while the fake Stripe rate limits every
+    7th request, repeats the import and checks that the repetition creates no duplicates,
+    then imports a second catalog as NDJSON. Needs the admin key like the other bulk endpoints.
+    """
+    app.stripe.api_base = fake.start(port=0)  # Any free port, importing the script (pytest) starts nothing
+    client = app.app.test_client()
+    app.key.admin_api_key = uuid.uuid4().hex
+    headers = {"X-Admin-Key": app.key.admin_api_key}
+    app.stripe_rate_limit_backoff = 0.01  # Keep the test fast
+    fake.rate_limit_every = 7
+
+    print("--- JSON list ---")
+    catalog = season_catalog("Winter") + [{'name': 'No price'}]
+    assert client.post("/product/bulk", json=catalog).status_code == 403
+    started = time.perf_counter()
+    response = client.post("/product/bulk", json=catalog, headers=headers)
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.json
+    print(f"Created {response.json['created']} products in {elapsed:.2f} s, failed: {response.json['failed']}")
+    assert response.json['created'] == PRODUCTS and len(fake.products) == PRODUCTS
+    assert response.json['results'][-1]['error'] == 'Invalid price'
+    with app.app.app_context():
+        assert app.Product.query.filter(app.Product.name.like("Winter item %")).count() == PRODUCTS
+
+    amounts = sorted(price['unit_amount'] for price in fake.prices.values())
+    expected = sorted(int(Decimal(str(item['price'])) * 100) for item in catalog if 'price' in item)
+    assert amounts == expected, "Prices like 16.99 must not be truncated to 1698 cents"
+    print("Prices in cents: OK")
+
+    print("\n--- Retry of the same import ---")
+    product_ids = [result.get('product_id') for result in response.json['results']]
+    response = client.post("/product/bulk", json=catalog, headers=headers)
+    assert response.status_code == 200, response.json
+    assert [result.get('product_id') for result in response.json['results']] == product_ids
+    assert len(fake.products) == PRODUCTS, "A repeated import must not create duplicates"
+    print("No duplicates: OK")
+
+    print("\n--- NDJSON ---")
+    body = "\n".join(json.dumps(item) for item in season_catalog("Summer")) + "\nnot json\n"
+    response = client.post("/product/bulk", data=body, content_type="application/x-ndjson", headers=headers)
+    assert response.status_code == 200, response.json
+    print(f"Created {response.json['created']} products, failed: {response.json['failed']}")
+    assert response.json['created'] == PRODUCTS and len(fake.products) == 2 * PRODUCTS
+    assert response.json['results'][-1]['error'] == 'Not a JSON object'
+
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import time
+from datetime import datetime
+from tests.v2.fake_stripe_server import FakeStripe
+import app
+
+fake = FakeStripe()
+
+PRODUCT = {'name': 'Season pass', 'description': 'All levels of the season', 'price': 9.99,
+           'metadata': {'coin_price': '1000'}}
+
+
+def wait_for_job(client, status_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(status_url).json
+        if job['status'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"Job didn't finish: {job}")
+
+
+def main():
+    """
+    Creates products with POST /product while the fake Stripe fails price creations,
+    and checks the retries, the recovery of a job whose process died after creating the
+    product, and the archiving of the product when the price can't be created at all.
+    """
+    app.stripe.api_base = fake.start(port=0)  # Any free port, importing the script (pytest) starts nothing
+    client = app.app.test_client()
+    app.job_retry_backoff = 0.05  # Keep the test fast
+
+    print("--- Retries ---")
+    fake.failing_prices = 2
+    started = time.perf_counter()
+    response = client.post("/product", json=PRODUCT)
+    print(f"POST /product answered {response.status_code} in {(time.perf_counter() - started) * 1000:.1f} ms")
+    assert response.status_code == 202, response.json
+    job = wait_for_job(client, response.headers['Location'])
+    print(f"Job {job['status']} after {job['attempts']} attempts")
+    assert job['status'] == 'succeeded' and job['attempts'] == 3
+    assert len(fake.products) == 1 and len(fake.prices) == 1, "Retries must not create a second product"
+    assert job['result']['id'] == job['progress']['product']
+
+    print("\n--- Recovery of a half-finished job ---")
+    product = fake.add_product("Recovered item")
+    with app.app.app_context():
+        job_id = app.enqueue_job('product_create', {'name': 'Recovered item', 'price': 4.99}).id
+        stuck = app.db.session.get(app.Job, job_id)
+        stuck.status, stuck.run_at, stuck.attempts = 'running', datetime(2000, 1, 1), 1  # Lease expired
+        stuck.progress = {'product': product}
+        app.db.session.commit()
+    app.job_pool.wake()
+    job = wait_for_job(client, f"/jobs/{job_id}")
+    assert job['status'] == 'succeeded', job
+    assert len(fake.products) == 2 and [p['product'] for p in fake.prices.values()].count(product['id']) == 1
+    print("Only the missing price was created: OK")
+
+    print("\n--- Permanent failure ---")
+    app.job_max_attempts = 2
+    fake.failing_prices = 2
+    response = client.post("/product", json={**PRODUCT, 'name': 'Broken item'})
+    job = wait_for_job(client, response.headers['Location'])
+    assert job['status'] == 'failed' and job['attempts'] == 2, job
+    assert fake.products[job['progress']['product']]['active'] is False, "The product without price is archived"
+    print(f"Job failed with '{job['error']}', product archived: OK")
+
+    app.job_pool.stop()
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
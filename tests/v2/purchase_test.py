@@ -0,0 +1,70 @@
+import threading
+import time
+import uuid
+from tests.v2.fake_stripe_server import FakeStripe
+import app
+import tests.test_users_infos as test_users_infos
+
+fake = FakeStripe()
+
+START_COINS = 100
+COIN_PRICE = 30
+THREADS = 10  # Purchases sent at the same time, only START_COINS // COIN_PRICE can succeed
+
+
+def main():
+    """
+    Buys a product with coins from several threads at once with a balance that is enough
+    for only some of them, and checks that exactly those purchases were written, each
+    with its ledger entry, and that the balance never went below zero.
+    Runs in-process with the Flask test client.
+    """
+    app.stripe.api_base = fake.start(port=0)  # Any free port, importing the script (pytest) starts nothing
+    client = app.app.test_client()
+    product = fake.add_product("Sword", metadata={'coin_price': str(COIN_PRICE)})
+    fake.add_price(product['id'], 499)
+    with app.app.app_context():
+        app.sync_catalog(full=True)
+    app.catalog_sync_task.attempted_at = time.monotonic()  # No background syncs during the test
+
+    response = client.post("/account", json={"username": f"buyer_{uuid.uuid4().hex[:6]}",
+                                             "password": test_users_infos.password})
+    assert response.status_code == 201, response.json
+    user = {"user_id": response.json["user_id"], "secret": response.json["secret"]}
+    assert client.put("/account", json={**user, "action": "add", "amount": START_COINS}).status_code == 200
+
+    print("--- Invalid purchases ---")
+    assert client.post("/purchase", json={**user, "secret": "wrong", "product_id": product['id']}).status_code == 401
+    assert client.post("/purchase", json={**user, "product_id": "prod_unknown"}).status_code == 404
+    print("Wrong secret and unknown product rejected: OK")
+
+    print("\n--- Concurrent purchases ---")
+    statuses = []
+
+    def buy():
+        response = app.app.test_client().post("/purchase", json={**user, "product_id": product['id']})
+        statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=buy) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    bought = statuses.count(201)
+    print(f"Statuses of {THREADS} purchases: {sorted(statuses)}")
+    assert bought == START_COINS // COIN_PRICE and statuses.count(400) == THREADS - bought
+
+    account = client.get("/account", query_string=user).json
+    with app.app.app_context():
+        purchases = app.PurchaseHistory.query.filter_by(user_id=user["user_id"]).count()
+        ledger = app.CoinTransaction.query.filter_by(user_id=user["user_id"], reason='purchase').count()
+        rebuilt = app.rebuild_coin_balance(user["user_id"])
+    assert account["coins"] == START_COINS - bought * COIN_PRICE == rebuilt
+    assert purchases == ledger == bought, "Every purchase needs its history row and ledger entry"
+    print(f"{bought} purchases, {account['coins']} coins left, history and ledger match: OK")
+
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import uuid
+import app
+import tests.test_users_infos as test_users_infos
+from tokens import TokenSigner
+
+
+def main():
+    """
+    Checks that tokens are disabled while no signing key is set and that a token signed
+    with the placeholder key is rejected, then enables tokens, uses them and logs out,
+    and checks that the tokens and the old secret are rejected afterwards while the
+    secret from the next login works. Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+    username = f"token_user_{uuid.uuid4().hex[:6]}"
+    user = client.post("/account", json={"username": username, "password": test_users_infos.password}).json
+    login = {"username": username, "password": test_users_infos.password}
+
+    print("--- Without a signing key ---")
+    assert not app.token_signer.enabled, "Set no token_signing_key in key.py for the test"
+    response = client.post("/login", json=login)
+    assert response.status_code == 200 and "access_token" not in response.json, response.json
+    forged = TokenSigner('Paste a long random value here', 60, 60).issue(user["user_id"])
+    response = client.get("/account", headers={"Authorization": f"Bearer {forged}"})
+    assert response.status_code == 401, response.json
+    assert client.post("/token/refresh", json={"refresh_token": forged}).status_code == 404
+    print("No tokens issued, token signed with the placeholder key rejected: OK")
+
+    print("\n--- With a signing key ---")
+    app.token_signer = TokenSigner(uuid.uuid4().hex * 2, app.access_token_ttl, app.refresh_token_ttl)
+    tokens = client.post("/login", json=login).json
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+    assert client.get("/account", headers=headers).status_code == 200
+    refreshed = client.post("/token/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert refreshed.status_code == 200 and "access_token" in refreshed.json, refreshed.json
+    print("Access and refresh token: OK")
+
+    print("\n--- Logout ---")
+    old = {"user_id": user["user_id"], "secret": tokens["secret"]}
+    assert client.get("/account", query_string=old).status_code == 200  # The secret is in auth_cache now
+    assert client.post("/logout", json=old).status_code == 200
+    assert client.get("/account", headers=headers).status_code == 401
+    assert client.post("/token/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+    assert client.get("/account", query_string=old).status_code == 401, "The old secret must stop working"
+    secret = client.post("/login", json=login).json["secret"]
+    assert secret != old["secret"]
+    assert client.get("/account", query_string={**old, "secret": secret}).status_code == 200
+    print("Tokens and the old secret rejected, the new secret works: OK")
+
+
+if __name__ == "__main__":
+    main()
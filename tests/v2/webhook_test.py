@@ -0,0 +1,119 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from datetime import datetime
+from sqlalchemy.exc import OperationalError
+import app
+import tests.test_users_infos as test_users_infos
+
+USERS = 3
+EVENTS = 300  # Paid checkout sessions, spread over the users
+THREADS = 10  # Concurrent deliveries, like Stripe during a sale
+COINS = 10  # Coins credited per checkout session
+
+
+def signed(payload, secret=None):
+    # Stripe-Signature header as Stripe builds it: HMAC-SHA256 of "timestamp.payload"
+    secret = secret or app.key.stripe_webhook_secret
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return {"Stripe-Signature": f"t={timestamp},v1={signature}", "Content-Type": "application/json"}
+
+
+def checkout_event(user_id):
+    return json.dumps({
+        "id": f"evt_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "created": int(time.time()),
+        "data": {"object": {"object": "checkout.session", "payment_status": "paid", "client_reference_id": user_id,
+                            "metadata": {"product_name": "Coin pack", "coins": str(COINS)}}}
+    })
+
+
+def main():
+    """
+    Delivers signed checkout events from several threads, some of them twice, plus one with
+    a wrong signature and one for an unknown user. Every event must be applied exactly once,
+    and before a signing secret is set none may be accepted.
+    Runs in-process with the Flask test client.
+    """
+    client = app.app.test_client()
+    payload = checkout_event("no-such-user")
+    app.key.stripe_webhook_secret = "Paste the signing secret of your Stripe webhook endpoint (whsec_...) here"
+    assert client.post("/webhook/stripe", data=payload, headers=signed(payload)).status_code == 503
+    app.key.stripe_webhook_secret = f"whsec_{uuid.uuid4().hex}"
+    print("Nothing accepted without a signing secret: OK")
+
+    users = []
+    for _ in range(USERS):
+        response = client.post("/account", json={"username": f"webhook_user_{uuid.uuid4().hex[:6]}",
+                                                  "password": test_users_infos.password})
+        assert response.status_code == 201, response.json
+        users.append((response.json["user_id"], response.json["secret"]))
+
+    events = [checkout_event(users[i % USERS][0]) for i in range(EVENTS)]
+    deliveries = events + events[:50]  # Stripe delivers some events more than once
+    latencies = []
+
+    def deliver(chunk):
+        thread_client = app.app.test_client()
+        for payload in chunk:
+            started = time.perf_counter()
+            response = thread_client.post("/webhook/stripe", data=payload, headers=signed(payload))
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.json
+
+    threads = [threading.Thread(target=deliver, args=(deliveries[i::THREADS],)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"{len(deliveries)} deliveries, {sum(latencies) / len(latencies) * 1000:.2f} ms on average")
+
+    payload = checkout_event(users[0][0])
+    response = client.post("/webhook/stripe", data=payload, headers=signed(payload, secret="wrong"))
+    assert response.status_code == 400, response.json
+    unknown = checkout_event("no-such-user")
+    assert client.post("/webhook/stripe", data=unknown, headers=signed(unknown)).status_code == 200
+
+    app.webhook_worker.stop()  # Waits until the queued events are applied
+    for index, (user_id, secret) in enumerate(users):
+        expected = len(range(index, EVENTS, USERS))
+        account = client.get("/account", query_string={"user_id": user_id, "secret": secret}).json
+        print(f"User {index + 1}: {account['purchase_count']} purchases, {account['coins']} coins")
+        assert account["purchase_count"] == expected and account["coins"] == expected * COINS
+    with app.app.app_context():
+        failed = app.db.session.get(app.StripeEvent, json.loads(unknown)["id"])
+        assert failed.processed_at and "Unknown user" in failed.error
+    print("Every event applied exactly once: OK")
+
+    print("\n--- Transient error ---")
+    apply_event = app._apply_stripe_event
+
+    def locked(payload):
+        raise OperationalError("UPDATE user", {}, Exception("database is locked"))
+
+    app._apply_stripe_event = locked
+    payload = checkout_event(users[0][0])
+    assert client.post("/webhook/stripe", data=payload, headers=signed(payload)).status_code == 200
+    webhook_id = json.loads(payload)["id"]
+    with app.app.app_context():
+        app.process_stripe_events([webhook_id])
+        event = app.db.session.get(app.StripeEvent, webhook_id)
+        assert event.processed_at is None and event.attempts == 1 and event.next_attempt_at, "Must be retried"
+        app._apply_stripe_event = apply_event
+        app.db.session.execute(app.db.update(app.StripeEvent).where(app.StripeEvent.id == webhook_id).values(
+            next_attempt_at=datetime(2000, 1, 1)))  # Retry is due
+        app.db.session.commit()
+        assert app.process_pending_stripe_events(older_than=3600) == 1
+    account = client.get("/account", query_string={"user_id": users[0][0], "secret": users[0][1]}).json
+    assert account["coins"] == (len(range(0, EVENTS, USERS)) + 1) * COINS
+    print("Event applied by the retry after a locked database: OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class TokenSigner:
+    def __init__(self, key, access_ttl=900, refresh_ttl=30 * 24 * 3600):
+        """
+        Issues and verifies HMAC-SHA256 signed tokens that carry the user ID, the token
+        type, the issue time and the expiry. Access tokens live `access_ttl` seconds,
+        refresh tokens `refresh_ttl` seconds. Verifying needs no database and no key
+        derivation, only one HMAC. Without a key (None or empty) tokens are disabled:
+        issue() raises ValueError and verify() accepts no token.
+        """
+        self.key = key.encode() if isinstance(key, str) else key
+        self.enabled = bool(self.key)
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+
+    def issue(self, user_id, token_type='access'):
+        if not self.enabled:
+            raise ValueError("Tokens are disabled, no signing key is set")
+        now = time.time()
+        payload = {
+            'sub': user_id,
+            'typ': token_type,
+            'iat': round(now, 3),
+            'exp': int(now + (self.access_ttl if token_type == 'access' else self.refresh_ttl)),
+            'jti': uuid.uuid4().hex
+        }
+        body = _b64encode(json.dumps(payload, separators=(',', ':')).encode())
+        return f"{body}.{self._sign(body)}"
+
+    def verify(self, token, token_type='access'):
+        """Returns the payload of a valid, unexpired token of the given type, otherwise None."""
+        if not self.enabled:
+            return None
+        try:
+            body, signature = token.split('.')
+            if not hmac.compare_digest(signature, self._sign(body)):
+                return None
+            payload = json.loads(_b64decode(body))
+        except (ValueError, AttributeError):
+            return None
+        if payload.get('typ') != token_type or payload.get('exp', 0) < time.time():
+            return None
+        return payload
+
+    def _sign(self, body):
+        return _b64encode(hmac.new(self.key, body.encode(), hashlib.sha256).digest())
+
+
+class RevocationList:
+    def __init__(self, loader, refresh_interval=10):
+        """
+        Keeps {user_id: revoked_before} in memory; tokens of a user issued before that
+        time are revoked. `loader` returns the current entries and is called again
+        when the copy is older than `refresh_interval` seconds, so revocations made by
+        other processes apply after at most that long.
+        """
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self._revoked = {}
+        self._loaded_at = None
+
+    def is_revoked(self, payload):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.refresh_interval:
+            self._revoked = dict(self.loader())
+            self._loaded_at = time.monotonic()
+        revoked_before = self._revoked.get(payload['sub'])
+        return revoked_before is not None and payload['iat'] <= revoked_before
+
+    def revoke(self, user_id, revoked_before):
+        """Applies a revocation in this process right away."""
+        self._revoked[user_id] = max(revoked_before, self._revoked.get(user_id, 0))